@@ -14,10 +14,12 @@ try:
     from ..methods import fd
     from ..methods import binomial as bi
     from ..methods import mc
+    from ..methods import bs
 except:
     import methods.fd as fd
     import methods.mc as mc
     import methods.binomial as bi
+    import methods.bs as bs
 
 ## Main class for the creation of the option chain. Must be called for initialization
 class option_chain():
@@ -27,7 +29,7 @@ class option_chain():
     # @param sigma = Volatility of the asset (\f$\sigma\f$)
     # @param T = Time to expiry
     # @param range = Tuple range of the spot prices we wish to examine
-    # @param method = either Binomial Method 'bi' or Monte Carlo method 'mc'
+    # @param method = Closed form 'bs', Binomial Method 'bi', Monte Carlo method 'mc', Finite Difference 'fd' or 'all' to compare every engine
     def __init__(self, S, r, sigma, T=1, range=(-10,1,10), method='bi'):
         
         ##Spot Price of asset
@@ -40,7 +42,7 @@ class option_chain():
         self.T = T
         ##Tuple range of the spot prices we wish to examine
         self.range = range
-        ##either Binomial Method 'bi' or Monte Carlo method 'mc'
+        ##Closed form 'bs', Binomial Method 'bi', Monte Carlo method 'mc', Finite Difference 'fd' or 'all'
         self.meth = method
     
     ## Generates the option chain
@@ -55,27 +57,91 @@ class option_chain():
         bottom = self.range[0]
         top = self.range[2]
         iter = self.range[1]
+        strikes = range(bottom,top+iter,iter)
         
-        if self.meth == 'bi':
-            for E in range(bottom,top+iter,iter):
-                solver = bi.binomial_euro(S=self.S,E=E,r=self.r,M=400,sigma=self.sigma,method='higham',T=self.T,opt='put')
-                self.put[E] = solver.solve()
-                del solver
-            for E in range(bottom,top+iter,iter):
-                solver = bi.binomial_euro(S=self.S,E=E,r=self.r,M=400,sigma=self.sigma,method='higham',T=self.T,opt='call')
-                self.call[E] = solver.solve()
-                del solver
+        if self.meth == 'bs':
+            self.put,self.call = self.price_bs(strikes)
+        elif self.meth == 'bi':
+            self.put,self.call = self.price_bi(strikes)
         elif self.meth == 'mc':
-            for E in range(bottom,top+iter,iter):
-                solver = mc.mcfast_euro(S=self.S,E=E,r=self.r,M=20000,sigma=self.sigma,T=self.T,opt='put')
-                self.put[E] = solver.solve()
-                del solver
-            for E in range(bottom,top+iter,iter):
-                solver = mc.mcfast_euro(S=self.S,E=E,r=self.r,M=20000,sigma=self.sigma,T=self.T,opt='call')
-                self.call[E] = solver.solve()
-                del solver
+            self.put,self.call = self.price_mc(strikes)
+        elif self.meth == 'fd':
+            self.put,self.call = self.price_fd(strikes)
         elif self.meth == 'all':
-            pass
+            ##Dictionary of (put, call) dictionaries for every engine
+            self.engines = {}
+            for meth in ('bi','mc','fd'):
+                self.engines[meth] = getattr(self,'price_'+meth)(strikes)
+            ##Closed form (put, call) dictionaries the engines are checked against
+            self.reference = self.price_bs(strikes)
+            ##Dictionary of the (put, call) spread between the engines
+            self.spread = {}
+            ##Dictionary of the per strike (put, call) errors of every engine against the closed form
+            self.error = dict((meth,{}) for meth in self.engines)
+            for E in strikes:
+                puts = [self.engines[meth][0][E] for meth in self.engines]
+                calls = [self.engines[meth][1][E] for meth in self.engines]
+                self.put[E] = sum(puts)/len(puts)
+                self.call[E] = sum(calls)/len(calls)
+                self.spread[E] = (max(puts)-min(puts),max(calls)-min(calls))
+                for meth in self.engines:
+                    self.error[meth][E] = (self.engines[meth][0][E]-self.reference[0][E],self.engines[meth][1][E]-self.reference[1][E])
+        else:
+            raise ValueError("Unknown chain method: "+str(self.meth))
+    
+    ## Prices the chain in closed form, all strikes and both option types in one vectorized call
+    def price_bs(self, strikes):
+        n = len(strikes)
+        V = bs.bs_value(self.S,strikes+strikes,self.r,self.sigma,self.T,['put']*n+['call']*n)
+        put = dict((E,float(V[j])) for j,E in enumerate(strikes))
+        call = dict((E,float(V[n+j])) for j,E in enumerate(strikes))
+        return put,call
+    
+    ## Prices the chain with a single batched binomial tree
+    #
+    # Returns dictionaries of put and call values keyed by strike.
+    def price_bi(self, strikes):
+        put = {}
+        call = {}
+        n = len(strikes)
+        solver = bi.binomial_batch(S=self.S,E=strikes+strikes,r=self.r,M=400,sigma=self.sigma,method='higham',T=self.T,opt=['put']*n+['call']*n)
+        V = solver.solve()
+        for j,E in enumerate(strikes):
+            put[E] = float(V[j])
+            call[E] = float(V[n+j])
+        return put,call
+    
+    ## Prices the chain with one batched Monte Carlo solve on common random numbers
+    def price_mc(self, strikes):
+        put = {}
+        call = {}
+        n = len(strikes)
+        solver = mc.mcfast_batch(S=self.S,E=strikes+strikes,r=self.r,M=20000,sigma=self.sigma,T=self.T,opt=['put']*n+['call']*n)
+        V = solver.solve()
+        for j,E in enumerate(strikes):
+            put[E] = float(V[j])
+            call[E] = float(V[n+j])
+        return put,call
+    
+    ## Prices the chain from one put and one call finite difference solve
+    #
+    # The Black-Scholes value is homogeneous of degree one in (S, E),
+    # \f[ V(S,E) = E \, V(S/E, 1), \f]
+    # so a single grid solved for a unit strike is rescaled and interpolated at \f$S/E\f$ for every strike,
+    # which requires every strike to be positive.
+    def price_fd(self, strikes):
+        if min(strikes) <= 0:
+            raise ValueError("The finite difference chain needs positive strikes, got a range starting at "+str(min(strikes)))
+        put = {}
+        call = {}
+        L = 3.0*max(1.0,float(self.S)/min(strikes))
+        for opt,values in (('put',put),('call',call)):
+            solver = fd.BS_fd_implicit(S=1.0,E=1.0,r=self.r,sigma=self.sigma,L=L,T=self.T,k=100,M=400,opt=opt,grid='sinh')
+            U = solver.solve_1d_surface()
+            for E in strikes:
+                values[E] = float(E*fd.interp_cubic(solver.x,U,float(self.S)/E))
+            del solver
+        return put,call
     
     ## Exports the result into a CSV file that may be opened in excel
     # @param filename = string filename to output. Please add extension CSV for proper functioning
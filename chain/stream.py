@@ -0,0 +1,203 @@
+## @package pyFi.chain.stream
+# Contains the tick driven streaming re-pricing of option chains.
+#
+# The pipeline is a chain of generator stages,
+# \f[ \mathrm{ticks} \rightarrow \mathrm{coalesce} \rightarrow \mathrm{deadline} \rightarrow \mathrm{reprice} \f]
+# each pulling spot/rate ticks from the one before. Every stage stamps the ticks passing through it,
+# so the latency of each stage is recorded separately.
+
+import sys
+sys.path.append('../')
+import time
+import threading
+import Queue
+from collections import namedtuple
+from numpy import *
+try:
+    from ..quotes import api
+except:
+    import quotes.api as api
+
+## Changed part of the chain emitted for one tick
+#
+# put and call are dictionaries of the strikes whose value moved by more than the tolerance, latency
+# the time in seconds from the arrival of the tick to its emission.
+chain_update = namedtuple('chain_update',['time','S','r','put','call','latency'])
+
+## Spot and rate observation
+class tick():
+    ## Called upon initialization of the tick
+    #
+    # @param time = arrival time, on the clock of the pipeline
+    # @param S = Spot Price of asset
+    # @param r = Risk free interest rate
+    def __init__(self, time, S, r):
+        self.time = time
+        self.S = S
+        self.r = r
+        ##Time at which each stage passed the tick on
+        self.stamps = {}
+
+## Replays ticks from a CSV file of time,spot,rate lines
+#
+# @param filename = file to replay, times in seconds
+# @param speed = replay speed, 1.0 for real time (defaults to None, as fast as possible)
+# @param clock = time function of the pipeline (defaults to time.time)
+def replay_ticks(filename, speed=None, clock=time.time):
+    f = open(filename)
+    start = clock()
+    t0 = None
+    for line in f:
+        fields = line.strip().split(',')
+        try:
+            t,S,r = [float(x) for x in fields[:3]]
+        except ValueError:
+            # header or blank line
+            continue
+        if speed is not None:
+            if t0 is None:
+                t0 = t
+            wait = start + (t-t0)/speed - clock()
+            if wait > 0:
+                time.sleep(wait)
+        yield tick(clock(),S,r)
+    f.close()
+
+## Polls quotes.api for live ticks
+#
+# Failed quotes are skipped. The rate comes from the shared quote cache, so it is only fetched again
+# once its TTL has expired.
+# @param symbol = stock symbol
+# @param interval = seconds between polls (defaults to 1.0)
+# @param source = quote source, 'google' or 'yahoo' (defaults to 'google')
+# @param count = number of polls (defaults to None, forever)
+def quote_ticks(symbol, interval=1.0, source='google', count=None, clock=time.time):
+    n = 0
+    while count is None or n < count:
+        n += 1
+        spot = api.client(source).fetch(symbol)
+        rate = api.client('risk_free').fetch()
+        if spot.error is None and rate.error is None:
+            yield tick(clock(),spot.value,rate.value)
+        time.sleep(interval)
+
+## Streaming re-pricing of an option chain
+class chain_stream():
+    ## Called upon initialization of the stream
+    #
+    # @param chain = option_chain to reprice, its spot and rate are overwritten by the ticks
+    # @param tol = smallest change of a put or call value that is emitted (defaults to 1e-4)
+    # @param window = ticks arriving within window seconds of the first one of a burst are merged into
+    # the last of them (defaults to 0.05)
+    # @param deadline = ticks older than deadline seconds when pricing would start are dropped (defaults to 0.5)
+    # @param clock = time function, must match the one of the tick source (defaults to time.time)
+    def __init__(self, chain, tol=1e-4, window=0.05, deadline=0.5, clock=time.time):
+        self.chain = chain
+        self.tol = tol
+        self.window = window
+        self.deadline = deadline
+        self.clock = clock
+        ##Last emitted (put, call) values keyed by strike
+        self.last = {}
+        ##Latencies in seconds of every tick through each stage
+        self.latency = {'coalesce': [], 'deadline': [], 'reprice': [], 'total': []}
+        ##Number of ticks merged into a later one
+        self.coalesced = 0
+        ##Number of ticks dropped as stale
+        self.dropped = 0
+
+    ## Records the time a tick spent in a stage since the previous stamp
+    def stamp(self, t, stage, previous):
+        now = self.clock()
+        t.stamps[stage] = now
+        self.latency[stage].append(now - (t.stamps[previous] if previous else t.time))
+
+    ## Merges bursts of ticks, passing on only the last tick of each burst
+    #
+    # The source is read by a background thread into a queue, so ticks keep arriving while the chain
+    # is being priced. A burst is everything that arrives up to window seconds after its first tick,
+    # plus whatever piled up in the queue meanwhile, and only its last tick is passed on.
+    def coalesce(self, ticks):
+        queue = Queue.Queue()
+        def read():
+            try:
+                for t in ticks:
+                    queue.put(t)
+            finally:
+                queue.put(None)
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        
+        t = queue.get()
+        finished = t is None
+        while not finished:
+            end = t.time + self.window
+            while True:
+                wait = end - self.clock()
+                try:
+                    following = queue.get(timeout=wait) if wait > 0 else queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if following is None:
+                    finished = True
+                    break
+                self.coalesced += 1
+                t = following
+            self.stamp(t,'coalesce',None)
+            yield t
+            if not finished:
+                t = queue.get()
+                finished = t is None
+
+    ## Drops the ticks that are already older than the deadline
+    def fresh(self, ticks):
+        for t in ticks:
+            if self.clock() - t.time > self.deadline:
+                self.dropped += 1
+                continue
+            self.stamp(t,'deadline','coalesce')
+            yield t
+
+    ## Reprices the chain for every tick and emits the strikes that changed
+    def reprice(self, ticks):
+        for t in ticks:
+            self.chain.S = t.S
+            self.chain.r = t.r
+            self.chain.generate()
+            put = {}
+            call = {}
+            for E in self.chain.put:
+                p,c = self.chain.put[E],self.chain.call[E]
+                old = self.last.get(E)
+                if old is None or abs(p-old[0]) > self.tol or abs(c-old[1]) > self.tol:
+                    put[E] = p
+                    call[E] = c
+                    self.last[E] = (p,c)
+            self.stamp(t,'reprice','deadline')
+            self.latency['total'].append(t.stamps['reprice']-t.time)
+            if put:
+                yield chain_update(t.time,t.S,t.r,put,call,t.stamps['reprice']-t.time)
+
+    ## Runs the whole pipeline on a tick source, yielding chain_updates
+    def run(self, ticks):
+        return self.reprice(self.fresh(self.coalesce(ticks)))
+
+    ## Count, mean, median, 99th percentile and maximum of the latency of each stage, in seconds
+    def latency_stats(self):
+        stats = {}
+        for stage,values in self.latency.items():
+            if values:
+                v = array(values)
+                stats[stage] = {'count': len(v), 'mean': mean(v), 'p50': percentile(v,50),
+                                'p99': percentile(v,99), 'max': v.max()}
+        return stats
+
+
+if __name__ == '__main__':
+    from chain import option_chain
+    chain = option_chain(528.74,0.0011,0.3357,T=2.0/252.0,range=(480,5,580),method='bs')
+    stream = chain_stream(chain,tol=0.01)
+    for update in stream.run(quote_ticks('GOOG',count=10)):
+        print update.S, sorted(update.put)
+    print stream.latency_stats()
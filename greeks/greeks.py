@@ -0,0 +1,177 @@
+## @package pyFi.greeks.greeks
+# Contains the option sensitivities (Greeks) computed from a single pass of each solver.
+#
+# Every function returns a dictionary keyed by 'value', 'delta', 'gamma', 'theta' and, where the
+# source provides them, 'vega' and 'rho'. Theta is the derivative with respect to calendar time,
+# \f$\Theta = \partial V / \partial t = -\partial V / \partial T\f$, in the units of T.
+
+import sys
+sys.path.append('../')
+from numpy import *
+from scipy.special import ndtr
+try:
+    from ..methods import bs
+    from ..methods import binomial
+    from ..methods import mc
+    from ..methods import sampling
+except:
+    import methods.bs as bs
+    import methods.binomial as binomial
+    import methods.mc as mc
+    import methods.sampling as sampling
+
+## Closed form Black-Scholes Greeks, vectorized over a whole chain
+#
+# All arguments broadcast like bs.bs_value. With \f$\phi = \pm 1\f$ for calls and puts,
+# \f[ \Delta = \phi N(\phi d_1), \quad \Gamma = \frac{ N'(d_1) }{ S \sigma \sqrt{T} }, \quad \nu = S N'(d_1) \sqrt{T} \f]
+# \f[ \Theta = -\frac{ S N'(d_1) \sigma }{ 2 \sqrt{T} } - \phi r E e^{-rT} N(\phi d_2), \quad \rho = \phi E T e^{-rT} N(\phi d_2) \f]
+def bs_greeks(S, E, r, sigma, T, opt='call'):
+    S,E,r,sigma,T = broadcast_arrays(*[asarray(x,dtype=float64) for x in (S,E,r,sigma,T)])
+    phi = bs.option_sign(opt)
+    d1,d2 = bs.d1_d2(S,E,r,sigma,T)
+    nd1 = exp(-0.5*d1*d1)/sqrt(2.0*pi)
+    disc = E*exp(-r*T)
+    Nd1 = ndtr(phi*d1)
+    Nd2 = ndtr(phi*d2)
+    return {'value': phi*(S*Nd1 - disc*Nd2),
+            'delta': phi*Nd1,
+            'gamma': nd1/(S*sigma*sqrt(T)),
+            'vega': S*nd1*sqrt(T),
+            'theta': -0.5*S*nd1*sigma/sqrt(T) - phi*r*disc*Nd2,
+            'rho': phi*T*disc*Nd2}
+
+## Asset prices of a node level, along the last axis of the solver's level arrays
+def level_prices(solver, i):
+    if solver.method=='trinomial':
+        return solver.S*solver.u**arange(-i,i+1)
+    n = arange(i+1)
+    return solver.S*solver.d**(i-n)*solver.u**n
+
+## Delta, gamma and theta read off the first levels of one binomial or trinomial sweep
+#
+# Works for binomial_euro, binomial_amer and binomial_batch (one set of Greeks per strike).
+# On a binomial tree delta is the slope between the two nodes of level 1 and gamma the change of
+# slope across the three nodes of level 2,
+# \f[ \Delta = \frac{ V_1^1 - V_0^1 }{ S_1^1 - S_0^1 }, \quad
+#     \Gamma = \frac{ 2 }{ S_2^2 - S_0^2 } \left ( \frac{ V_2^2 - V_1^2 }{ S_2^2 - S_1^2 } - \frac{ V_1^2 - V_0^2 }{ S_1^2 - S_0^2 } \right ) \f]
+# Theta compares the middle node of level 2 with the root, two timesteps earlier, after removing the
+# part due to \f$S_1^2 \ne S\f$ (the Higham and Kwok trees drift),
+# \f[ \Theta = \frac{ V_1^2 - V_0^0 - \Delta (S_1^2-S) - \frac{1}{2} \Gamma (S_1^2-S)^2 }{ 2 \delta t } \f]
+# The trinomial lattice has three nodes on level 1 already and uses it for all three.
+# With smooth='bbsr' the Greeks of the BBS trees with M and M/2 steps are extrapolated like the price,
+# \f$2G_M - G_{M/2}\f$.
+# @param solver = binomial solver, solved here
+# @param smooth = None, 'bbs' or 'bbsr', passed on to binomial_amer.solve, other solvers only take None
+# (defaults to None)
+def binomial_greeks(solver, smooth=None):
+    if smooth is not None and not isinstance(solver,binomial.binomial_amer):
+        raise ValueError("smooth=%s needs a binomial_amer solver, got %s" % (smooth,solver.__class__.__name__))
+    if smooth=='bbsr':
+        half = solver.__class__(solver.S,solver.E,solver.r,solver.sigma,T=solver.T,M=solver.M//2,p=solver.p,opt=solver.opt,method=solver.method)
+        full = binomial_greeks(solver,'bbs')
+        half = binomial_greeks(half,'bbs')
+        return dict((name,2.0*full[name]-half[name]) for name in full)
+    if smooth is None:
+        solver.solve()
+    else:
+        solver.solve(smooth=smooth)
+    if solver.levels[-1] is None:
+        raise ValueError("The tree needs at least 3 steps for its Greeks")
+    V0 = solver.levels[0][...,0]
+    i = 1 if solver.method=='trinomial' else 2
+    s = level_prices(solver,i)
+    V = solver.levels[i]
+    lo = (V[...,1]-V[...,0])/(s[1]-s[0])
+    hi = (V[...,2]-V[...,1])/(s[2]-s[1])
+    gamma = 2.0*(hi-lo)/(s[2]-s[0])
+    if i==1:
+        delta = (V[...,2]-V[...,0])/(s[2]-s[0])
+    else:
+        s1 = level_prices(solver,1)
+        delta = (solver.levels[1][...,1]-solver.levels[1][...,0])/(s1[1]-s1[0])
+    shift = s[1]-solver.S
+    theta = (V[...,1] - V0 - delta*shift - 0.5*gamma*shift*shift)/(i*solver.dt)
+    return {'value': V0, 'delta': delta, 'gamma': gamma, 'theta': theta}
+
+## Delta, gamma and theta from one finite difference solve
+#
+# Works with BS_fd_explicit and BS_fd_implicit. The surface of solve_2d_surface gives the solution
+# at \f$\tau = T\f$ and the stored levels just before it. Delta and gamma are the first two derivatives
+# of the cubic through the four grid nodes around S, and theta the one sided second order difference
+# \f[ \Theta = -\frac{ 3 U^{K} - 4 U^{K-1} + U^{K-2} }{ 2 \, \mathrm{stride} \, \Delta t } \f]
+# interpolated at S in the same way.
+# @param solver = finite difference solver
+# @param stride = passed on to solve_2d_surface, k must be a multiple of it (defaults to 1)
+# @param filename = passed on to solve_2d_surface
+def fd_greeks(solver, stride=1, filename=None):
+    if solver.k%stride != 0 or solver.k//stride < 3:
+        raise ValueError("k must be a multiple of stride with at least 3 stored levels")
+    U = solver.solve_2d_surface(stride,filename)
+    x = solver.x
+    S = float(solver.S)
+    j = searchsorted(x,S)
+    i0 = min(max(j-2,0),len(x)-4)
+    xs = x[i0:i0+4]-S
+    rows = array([U[-1,i0:i0+4],U[-2,i0:i0+4],U[-3,i0:i0+4]])
+    # columns of c are the cubic coefficients (highest power first) of each row
+    c = polyfit(xs,rows.T,3)
+    V,V1,V2 = c[3]
+    return {'value': V,
+            'delta': c[2,0],
+            'gamma': 2.0*c[1,0],
+            'theta': -(3.0*V-4.0*V1+V2)/(2.0*stride*solver.dt)}
+
+## Monte Carlo Greeks on the same samples as the price
+#
+# With \f$S_T = S e^{(r-\sigma^2/2)T + \sigma\sqrt{T}Z}\f$, \f$D = e^{-rT}\f$ and \f$I\f$ the indicator of
+# exercise, the pathwise estimators are
+# \f[ \Delta = D \phi I \frac{ S_T }{ S }, \quad \nu = D \phi I S_T \left ( \sqrt{T}Z - \sigma T \right ), \quad
+#     \rho = T \left ( D \phi I S_T - V \right ), \quad
+#     \Theta = rV - D \phi I S_T \left ( r - \frac{ \sigma^2 }{ 2 } + \frac{ \sigma Z }{ 2\sqrt{T} } \right ) \f]
+# and, as the payoff derivative is discontinuous, gamma uses the likelihood ratio on top of the pathwise delta,
+# \f[ \Gamma = D \phi I \frac{ S_T }{ S^2 } \left ( \frac{ Z }{ \sigma\sqrt{T} } - 1 \right ) \f]
+# Samples are drawn in chunks and every estimator is reduced with mc.combine_stats.
+# Returns the dictionary of Greeks and a dictionary of their standard errors.
+# @param M = Number of samples (defaults to 1000000)
+# @param chunk = Maximum number of samples held in memory at once (defaults to 1000000)
+# @param sampler = 'pseudo', 'sobol' or 'halton' (defaults to 'pseudo')
+# @param seed = Optional seed for reproducible results
+def mc_greeks(S, E, r, sigma, T=1, M=1000000, opt='call', chunk=1000000, sampler='pseudo', seed=None):
+    phi = float(bs.option_sign(opt))
+    source = sampling.make_samplers(sampler,1,seed)[0]
+    D = exp(-r*T)
+    names = ('value','delta','gamma','vega','theta','rho')
+    stats = dict((name,(0,0.0,0.0)) for name in names)
+    done = 0
+    while done < M:
+        n = min(chunk,M-done)
+        Z = source.normals(n)
+        ST = S*exp((r-0.5*sigma*sigma)*T + sigma*sqrt(T)*Z)
+        payoff = D*maximum(phi*(ST-E),0)
+        dST = D*phi*(phi*(ST-E)>0)*ST
+        x = {'value': payoff,
+             'delta': dST/S,
+             'gamma': dST/(S*S)*(Z/(sigma*sqrt(T))-1.0),
+             'vega': dST*(sqrt(T)*Z-sigma*T),
+             'theta': r*payoff - dST*(r-0.5*sigma*sigma+0.5*sigma*Z/sqrt(T)),
+             'rho': T*(dST-payoff)}
+        for name in names:
+            stats[name] = mc.combine_stats(*(stats[name]+mc.chunk_stats(x[name])))
+        done += n
+    greeks = {}
+    stderr = {}
+    for name in names:
+        n,m,m2 = stats[name]
+        greeks[name] = m
+        stderr[name] = sqrt(m2/(n-1.0)/n)
+    return greeks,stderr
+
+
+if __name__ == '__main__':
+    from methods import binomial as bi
+    from methods import fd
+    print bs_greeks(100,100,0.05,0.2,1.0,'put')
+    print binomial_greeks(bi.binomial_euro(100,100,0.05,0.2,M=1000,opt='put'))
+    print binomial_greeks(bi.binomial_amer(100,100,0.05,0.2,M=1000,opt='put'))
+    print fd_greeks(fd.BS_fd_implicit(100,100,0.05,0.2,L=400,k=200,M=400,opt='put',grid='sinh'))
+    print mc_greeks(100,100,0.05,0.2,M=2000000,opt='put',seed=1)
@@ -0,0 +1,165 @@
+## @package pyFi.greeks.history
+# Contains the local on-disk store of daily price histories and the fetchers that fill it.
+#
+# Each symbol is kept as a directory of columns, one .npy file per column ('date' as proleptic
+# Gregorian ordinals, 'open', 'high', 'low' and 'close'), which are read back as memory maps.
+# Updates write a new version directory and then switch the symbol's 'current' pointer file to it.
+# A fetcher is any callable fetcher(symbol, start, end) returning a dictionary of these columns for
+# the trading days between the datetime.date objects start and end, inclusive.
+
+import os
+import time
+import shutil
+import datetime
+from numpy import *
+
+## Names of the stored columns
+columns = ('date','open','high','low','close')
+
+## Fetches daily prices from Yahoo Finance through pandas
+def yahoo_fetcher(symbol, start, end):
+    try:
+        from pandas.io.data import DataReader
+    except ImportError:
+        from pandas_datareader.data import DataReader
+    frame = DataReader(symbol,'yahoo',start,end)
+    data = {'date': array([d.toordinal() for d in frame.index],dtype=int64)}
+    for name in columns[1:]:
+        data[name] = asarray(frame[name.capitalize()],dtype=float64)
+    return data
+
+## Creates a fetcher reading Yahoo style CSV files (Date,Open,High,Low,Close,...) from a directory
+#
+# The file for a symbol is directory/SYMBOL.csv. Useful as an offline stand-in for yahoo_fetcher.
+def csv_fetcher(directory):
+    def fetch(symbol, start, end):
+        rows = []
+        f = open(os.path.join(directory,symbol+'.csv'))
+        header = f.readline().strip().split(',')
+        index = [header.index(name.capitalize()) for name in columns]
+        for line in f:
+            fields = line.strip().split(',')
+            if len(fields) < len(header):
+                continue
+            day = datetime.datetime.strptime(fields[index[0]],'%Y-%m-%d').date()
+            if start <= day <= end:
+                rows.append([day.toordinal()]+[float(fields[i]) for i in index[1:]])
+        f.close()
+        rows.sort()
+        data = {'date': array([row[0] for row in rows],dtype=int64)}
+        for j,name in enumerate(columns[1:]):
+            data[name] = array([row[j+1] for row in rows],dtype=float64)
+        return data
+    return fetch
+
+## Local store of daily price histories with incremental refresh
+class price_store():
+    ## Called upon initialization of the store
+    #
+    # @param root = directory holding the histories, created if needed
+    # @param fetcher = data source, see the package documentation (defaults to yahoo_fetcher)
+    # @param start = first date fetched for a new symbol (defaults to ten years ago)
+    def __init__(self, root, fetcher=None, start=None):
+        self.root = root
+        self.fetcher = fetcher if fetcher is not None else yahoo_fetcher
+        if start is None:
+            start = datetime.date.today() - datetime.timedelta(days=3652)
+        self.start = start
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    ## Directory of one symbol
+    def path(self, symbol):
+        return os.path.join(self.root,symbol.upper())
+
+    ## Current version directory of a symbol and the date it was checked up to, or (None, 0)
+    def current(self, symbol):
+        name = os.path.join(self.path(symbol),'current')
+        if not os.path.exists(name):
+            return None,0
+        f = open(name)
+        version,checked = f.read().split()
+        f.close()
+        return version,int(checked)
+
+    ## Returns the stored columns of a symbol as read-only memory maps, or None if nothing is stored
+    def load(self, symbol):
+        version = self.current(symbol)[0]
+        if version is None:
+            return None
+        path = os.path.join(self.path(symbol),version)
+        return dict((name,load(os.path.join(path,name+'.npy'),mmap_mode='r')) for name in columns)
+
+    ## Date up to which the symbol has been checked, as an ordinal (0 if never)
+    def checked(self, symbol):
+        return self.current(symbol)[1]
+
+    ## Writes a new version of a symbol and switches to it
+    #
+    # The columns go into a fresh version directory and only then the 'current' pointer file is
+    # replaced by a rename, so a reader always sees one consistent set of columns. With data None the
+    # current version is kept and only the checked date is updated. The version before the previous
+    # one is removed, which leaves readers that just switched time to finish.
+    def save(self, symbol, data, checked):
+        path = self.path(symbol)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        version = self.current(symbol)[0]
+        if data is not None:
+            version = 'v%d.%d' % (int(time.time()*1e6),os.getpid())
+            os.makedirs(os.path.join(path,version))
+            for name in columns:
+                save(os.path.join(path,version,name+'.npy'),asarray(data[name]))
+        tmp = os.path.join(path,'current.%d.tmp' % os.getpid())
+        f = open(tmp,'w')
+        f.write('%s %d\n' % (version,checked))
+        f.close()
+        os.rename(tmp,os.path.join(path,'current'))
+        old = sorted(v for v in os.listdir(path) if v.startswith('v') and v!=version)
+        for v in old[:-1]:
+            shutil.rmtree(os.path.join(path,v),ignore_errors=True)
+
+    ## Fetches only the dates after the last stored one and appends them
+    #
+    # The fetch starts the day after the last stored date, so bars that were not yet published at an
+    # earlier refresh are picked up by the next one. Once a symbol has been checked up to end nothing
+    # is fetched again that day, so repeated calls are local reads.
+    # @param end = last date wanted (defaults to today)
+    def refresh(self, symbol, end=None):
+        if end is None:
+            end = datetime.date.today()
+        if self.checked(symbol) >= end.toordinal():
+            return
+        old = self.load(symbol)
+        if old is not None and len(old['date']):
+            start = datetime.date.fromordinal(int(old['date'][-1])+1)
+        else:
+            start = self.start
+        new = self.fetcher(symbol,start,end)
+        if old is not None and len(old['date']):
+            keep = asarray(new['date']) > old['date'][-1]
+            if not any(keep):
+                self.save(symbol,None,end.toordinal())
+                return
+            for name in columns:
+                new[name] = concatenate((old[name],asarray(new[name])[keep]))
+        del old
+        self.save(symbol,new,end.toordinal())
+
+    ## Last closing prices of a symbol, refreshing the store first
+    #
+    # If the refresh fails the stored history is used as it is, an IOError is raised only when
+    # nothing is stored for the symbol.
+    # @param days = number of closes (None for the whole history)
+    # @param column = stored column to return (defaults to 'close')
+    def closes(self, symbol, days=None, column='close'):
+        try:
+            self.refresh(symbol)
+        except Exception as e:
+            if self.load(symbol) is None:
+                raise IOError("Problem getting the price history of %s: %s" % (symbol,e))
+        data = self.load(symbol)
+        if data is None:
+            raise IOError("No price history for "+symbol)
+        values = data[column]
+        return array(values if days is None else values[-days:])
@@ -0,0 +1,96 @@
+## @package pyFi.greeks.implied
+# Contains the implied volatility solver for whole option chains
+
+import sys
+sys.path.append('../')
+from numpy import *
+from scipy.special import ndtr
+try:
+    from ..methods import bs
+except:
+    import methods.bs as bs
+
+## Rational approximation of the implied volatility of calls (Corrado and Miller)
+#
+# With the discounted strike \f$K = E e^{-rT}\f$,
+# \f[ \sigma_0 = \frac{ \sqrt{2\pi/T} }{ S + K } \left ( C - \frac{ S-K }{ 2 } + \sqrt{ \left ( C - \frac{ S-K }{ 2 } \right )^2 - \frac{ (S-K)^2 }{ \pi } } \right ) \f]
+# where a negative root is replaced by zero. Exact at the money and within a few vol points near it.
+def initial_guess(C, S, K, T):
+    a = C - 0.5*(S-K)
+    root = sqrt(maximum(a*a - (S-K)**2/pi,0.0))
+    return maximum(sqrt(2.0*pi/T)/(S+K)*(a+root),1e-3)
+
+## Implied volatility of a chain of European options
+#
+# All arguments broadcast. Puts are turned into calls by put-call parity, then every option runs
+# safeguarded Newton iterations at once,
+# \f[ \sigma_{n+1} = \sigma_n - \frac{ C(\sigma_n) - C }{ \nu(\sigma_n) } \f]
+# Each option keeps a bracket \f$[\sigma_{lo},\sigma_{hi}]\f$ around its root, updated from the sign of the
+# price error, and a Newton step leaving it is replaced by bisection (or doubling while no upper
+# bound is known). Only the options that have not converged are iterated.
+# Prices outside the no-arbitrage bounds give NaN.
+# @param V = Market prices
+# @param S = Spot Price of asset
+# @param E = Exercise / Strike prices
+# @param r = Risk free interest rate
+# @param T = Time to expiry
+# @param opt = 'call', 'put' or an array of them (defaults to 'call')
+# @param tol = Convergence tolerance on the volatility (defaults to 1e-10)
+# @param maxiter = Maximum number of iterations (defaults to 100)
+# @param warm = Optional array of starting volatilities broadcasting with the prices, typically the
+# result of the previous tick for the same chain. NaN entries start from the rational guess.
+def implied_vol(V, S, E, r, T, opt='call', tol=1e-10, maxiter=100, warm=None):
+    V,S,E,r,T,opt = broadcast_arrays(*[asarray(x,dtype=float64) for x in (V,S,E,r,T)]+[asarray(opt)])
+    shape = V.shape
+    phi = bs.option_sign(opt).ravel()
+    S = S.ravel()
+    T = T.ravel()
+    # with the discounted strike the call value no longer depends on r
+    K = (E*exp(-r*T.reshape(shape))).ravel()
+    C = where(phi>0,V.ravel(),V.ravel()+S-K)
+
+    sigma = empty(C.shape)
+    sigma.fill(nan)
+    valid = (C>maximum(S-K,0.0)) & (C<S) & (T>0)
+
+    guess = initial_guess(C,S,K,T)
+    if warm is not None:
+        warm = broadcast_to(asarray(warm,dtype=float64),shape).ravel()
+        with errstate(invalid='ignore'):
+            guess = where(warm>0,warm,guess)
+    sigma[valid] = guess[valid]
+
+    lo = zeros(C.shape)
+    hi = empty(C.shape)
+    hi.fill(inf)
+    active = flatnonzero(valid)
+    for it in range(maxiter):
+        if len(active)==0:
+            break
+        s,c,k,t = sigma[active],C[active],K[active],T[active]
+        sp = S[active]
+        d1,d2 = bs.d1_d2(sp,k,0.0,s,t)
+        f = sp*ndtr(d1) - k*ndtr(d2) - c
+        vega = sp*exp(-0.5*d1*d1)*sqrt(t/(2.0*pi))
+        lo[active] = where(f<0,s,lo[active])
+        hi[active] = where(f>0,s,hi[active])
+        l,h = lo[active],hi[active]
+        with errstate(divide='ignore',invalid='ignore'):
+            new = s - f/vega
+        bad = ~((new>l) & (new<h))
+        new[bad] = where(isinf(h[bad]),2.0*s[bad],0.5*(l[bad]+h[bad]))
+        sigma[active] = new
+        done = (abs(new-s)<tol*maximum(s,1.0)) | (f==0)
+        active = active[~done]
+
+    sigma = sigma.reshape(shape)
+    return sigma[()] if sigma.ndim==0 else sigma
+
+
+if __name__ == '__main__':
+    E = linspace(50,150,11)
+    V = bs.bs_value(100,E,0.05,0.25,0.5,'put')
+    sigma = implied_vol(V,100,E,0.05,0.5,'put')
+    print sigma
+    # next tick, starting from the previous solution
+    print implied_vol(bs.bs_value(100.5,E,0.05,0.25,0.5,'put'),100.5,E,0.05,0.5,'put',warm=sigma)
@@ -1,9 +1,23 @@
 ## @package pyFi.greeks.volatility
 # This packages contains methods of determining volatility of financial instruments.
 
-from pandas.io.data import DataReader
-from pandas import np 
+import os
 from numpy import *
+from scipy.signal import lfilter
+try:
+    from .history import price_store
+except:
+    from history import price_store
+
+## Store used by hist_vol when none is given, created on first use under ~/.pyfi/history
+default = None
+
+## Returns the default price store
+def default_store():
+    global default
+    if default is None:
+        default = price_store(os.path.join(os.path.expanduser('~'),'.pyfi','history'))
+    return default
 
 ## Calculate annualized historical volatility for a stock, defaulted to 10 days
 #  @param sym Stock symbol for which we wish to get the historical volatility
@@ -29,17 +43,121 @@ from numpy import *
 #\f[
 #    \sigma_a = \sqrt{252b^2_M}.
 #\f]
-def hist_vol(sym, days=10):
-    try:
-        quotes = DataReader(sym, 'yahoo')['Close'][-days:]
-    except Exception:
-        print "Problem getting historical volatility!"
-        raise SystemExit(code)
-        return None, None
-    logreturns = np.log(quotes / quotes.shift(1))
-    vol = np.sqrt(252*logreturns.var()) #252 trading days in year (annualized volatility)
+#
+# The closes are read from a local price_store, which only fetches the dates missing since its last
+# refresh. An IOError is raised when no history can be obtained.
+#  @param store Optional price_store (defaults to default_store())
+def hist_vol(sym, days=10, store=None):
+    if store is None:
+        store = default_store()
+    quotes = store.closes(sym,days)
+    if len(quotes) < 3:
+        raise IOError("Not enough price history for "+sym)
+    logreturns = log(quotes[1:]/quotes[:-1])
+    vol = sqrt(252*var(logreturns,ddof=1)) #252 trading days in year (annualized volatility)
     return float(vol)
 
+## Aligned (dates x symbols) matrix of one stored column for many symbols
+#
+# Only the dates present for every symbol are kept.
+#  @param symbols Sequence of stock symbols
+#  @param days Number of most recent common dates to return (None for all)
+#  @param column Stored column, 'open', 'high', 'low' or 'close' (defaults to 'close')
+#  @param store Optional price_store (defaults to default_store())
+#
+# Returns the ordinal dates and the price matrix.
+def price_matrix(symbols, days=None, column='close', store=None):
+    if store is None:
+        store = default_store()
+    for sym in symbols:
+        store.closes(sym,1)
+    data = [store.load(sym) for sym in symbols]
+    dates = data[0]['date']
+    for d in data[1:]:
+        dates = intersect1d(dates,d['date'])
+    if days is not None:
+        dates = dates[-days:]
+    prices = empty((len(dates),len(symbols)))
+    for j,d in enumerate(data):
+        prices[:,j] = d[column][searchsorted(d['date'],dates)]
+    return dates,prices
+
+## Trailing means of x over window rows, from one cumulative sum along the dates
+#
+# \f[ \bar x_t = \frac{ 1 }{ w } \left ( C_t - C_{t-w} \right ), \quad C_t = \sum_{s \le t} x_s \f]
+# Rows without a full window are NaN.
+def rolling_mean(x, window):
+    c = cumsum(concatenate((zeros((1,)+x.shape[1:]),x)),axis=0)
+    m = empty(x.shape)
+    m[:window-1] = nan
+    m[window-1:] = (c[window:]-c[:-window])/float(window)
+    return m
+
+## Rolling close-to-close volatility of many symbols for several windows at once
+#
+# The returns are centred on their column means first, which leaves every windowed variance unchanged
+# but keeps the difference of cumulative sums well conditioned,
+# \f[ b_t^2 = \frac{ w }{ w-1 } \left ( \overline{U^2}_t - \bar U_t^2 \right ) \f]
+# A window of w returns needs w+1 closes, so hist_vol(sym, days) is the last row for window days-1.
+#  @param prices (dates x symbols) array of closes
+#  @param windows Sequence of window lengths in returns
+#  @param annual Periods per year (defaults to 252)
+#
+# Returns a dictionary mapping each window to a (dates-1 x symbols) array of annualized volatilities.
+def rolling_vol(prices, windows=(10,20,60), annual=252):
+    U = diff(log(asarray(prices,dtype=float64)),axis=0)
+    U = U - mean(U,axis=0)
+    vols = {}
+    for w in windows:
+        m1 = rolling_mean(U,w)
+        m2 = rolling_mean(U*U,w)
+        vols[w] = sqrt(annual*maximum(m2-m1*m1,0.0)*w/(w-1.0))
+    return vols
+
+## Exponentially weighted (RiskMetrics) volatility of many symbols
+#
+# \f[ b_t^2 = \lambda b_{t-1}^2 + (1-\lambda) U_t^2, \quad b_0^2 = U_0^2 \f]
+# run as one linear filter along the dates for every symbol at once.
+#  @param prices (dates x symbols) array of closes
+#  @param lam Decay factor \f$\lambda\f$ (defaults to 0.94)
+#  @param annual Periods per year (defaults to 252)
+def ewma_vol(prices, lam=0.94, annual=252):
+    U2 = diff(log(asarray(prices,dtype=float64)),axis=0)**2
+    b2 = lfilter([1.0-lam],[1.0,-lam],U2,axis=0,zi=lam*U2[0:1])[0]
+    return sqrt(annual*b2)
+
+## Rolling Parkinson (high-low range) volatility of many symbols
+#
+# \f[ b_t^2 = \frac{ 1 }{ 4 \log 2 } \overline{ \log^2 (H/L) }_t \f]
+#  @param high (dates x symbols) array of daily highs
+#  @param low (dates x symbols) array of daily lows
+def parkinson_vol(high, low, windows=(10,20,60), annual=252):
+    x = log(asarray(high,dtype=float64)/low)**2/(4.0*log(2.0))
+    return dict((w,sqrt(annual*rolling_mean(x,w))) for w in windows)
+
+## Rolling Garman-Klass volatility of many symbols
+#
+# \f[ b_t^2 = \overline{ \frac{ 1 }{ 2 } \log^2 (H/L) - (2 \log 2 - 1) \log^2 (C/O) }_t \f]
+#  @param open, high, low, close (dates x symbols) arrays of daily prices
+def garman_klass_vol(open, high, low, close, windows=(10,20,60), annual=252):
+    x = 0.5*log(asarray(high,dtype=float64)/low)**2 - (2.0*log(2.0)-1.0)*log(asarray(close,dtype=float64)/open)**2
+    return dict((w,sqrt(annual*rolling_mean(x,w))) for w in windows)
+
+## All volatility estimators for a (dates x symbols) universe in one call
+#
+# The range based estimators are included when high and low (and open for Garman-Klass) are given.
+# The last row of every array is the current volatility of each symbol, a sigma vector that can be
+# passed straight to bs.bs_value or greeks.bs_greeks.
+#
+# Returns a dictionary with 'close' and, when available, 'parkinson' and 'garman_klass', each mapping
+# the windows to their arrays, and 'ewma' holding the EWMA array.
+def batch_vol(close, windows=(10,20,60), high=None, low=None, open=None, lam=0.94, annual=252):
+    vols = {'close': rolling_vol(close,windows,annual), 'ewma': ewma_vol(close,lam,annual)}
+    if high is not None and low is not None:
+        vols['parkinson'] = parkinson_vol(high,low,windows,annual)
+        if open is not None:
+            vols['garman_klass'] = garman_klass_vol(open,high,low,close,windows,annual)
+    return vols
     
 
 if __name__ == '__main__':
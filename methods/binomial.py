@@ -1,6 +1,10 @@
 ## @package pyFi.methods.binomial
 # Contains binomial method solvers for options
 from numpy import *
+try:
+    from .bs import bs_value
+except:
+    from bs import bs_value
 class binomial_euro():
     ## Called upon initialization of the binomial method for Europeans
     #
@@ -12,7 +16,7 @@ class binomial_euro():
     # @param M = Size of binomial tree (defaults to 400)
     # @param p = probability (defaults to 0.4)
     # @param opt = 'call' or 'put' (defaults to 'call')
-    # @param method = u,d method, either 'higham', 'kwok' or 'crr' (defaults to 'higham')
+    # @param method = u,d method, either 'higham', 'kwok', 'crr', Leisen-Reimer 'lr' or 'trinomial' (defaults to 'higham')
     def __init__(self, S, E, r, sigma, T=1.0, M=400, p=0.5, opt='call', method='higham'):
         self.S = S
         self.E = E
@@ -21,22 +25,49 @@ class binomial_euro():
         self.sigma = sigma
         self.M = M
         self.p = p
-        self.dt = T/M
         
-        if method=='higham':
-            self.u,self.d = self.ud_higham()
-        elif method=='crr':
-            self.u,self.d = self.ud_crr()
-        elif method=='kwok':
-            self.u,self.d = self.ud_kwok()
-        else:
-            self.u,self.d = 0
+        self.lattice(method)
         
         if opt=='call':
             self.W = self.final_values_call()
         elif opt=='put':
             self.W = self.final_values_put()
     
+    ## Sets the timestep and the u,d and probability values of the lattice
+    #
+    # Leisen-Reimer needs an odd number of steps, so an even M is bumped up by one.
+    # Both 'lr' and 'trinomial' fix their own probabilities and override p.
+    # @param method = u,d method, either 'higham', 'kwok', 'crr', 'lr' or 'trinomial'
+    def lattice(self, method):
+        self.method = method
+        if method=='lr' and self.M%2==0:
+            self.M += 1
+        self.dt = float(self.T)/self.M
+        
+        self.u,self.d = self.ud(method)
+        
+        if method=='lr':
+            self.p = self.p_lr()[0]
+        elif method=='trinomial':
+            self.pu,self.pm,self.pd = self.p_trinomial()
+    
+    ## Selects the u,d values for the requested method
+    #
+    # @param method = u,d method, either 'higham', 'kwok', 'crr', 'lr' or 'trinomial'
+    def ud(self, method):
+        if method=='higham':
+            return self.ud_higham()
+        elif method=='crr':
+            return self.ud_crr()
+        elif method=='kwok':
+            return self.ud_kwok()
+        elif method=='lr':
+            return self.ud_lr()
+        elif method=='trinomial':
+            return self.ud_trinomial()
+        else:
+            raise ValueError("Unknown u,d method: "+str(method))
+    
     ## u,d values from Higham
     #
     # \f[ u = e^{\sigma \sqrt{\delta t} + \left ( r - \frac{ \sigma^2 }{ 2 } \right ) \delta t}\f]
@@ -64,15 +95,66 @@ class binomial_euro():
         d = exp(self.sigma*sqrt(self.dt)*(1.0-sqrt(exp(self.sigma*self.sigma*self.dt-1.0))))
         return u,d
     
+    ## Peizer-Pratt inversion (method 2) of the normal distribution
+    #
+    # \f[ h(z) = \frac{1}{2} + \frac{\mathrm{sign}(z)}{2} \sqrt{ 1 - \exp \left [ -\left ( \frac{ z }{ M + \frac{1}{3} + \frac{0.1}{M+1} } \right )^2 \left ( M + \frac{1}{6} \right ) \right ] } \f]
+    def peizer_pratt(self, z):
+        x = z/(self.M + 1.0/3.0 + 0.1/(self.M+1.0))
+        return 0.5 + 0.5*sign(z)*sqrt(1.0 - exp(-x*x*(self.M + 1.0/6.0)))
+    
+    ## Probabilities of Leisen and Reimer
+    #
+    # \f[ p = h(d_2), \quad \bar p = h(d_1) \f]
+    # where \f$d_{1,2}\f$ are the Black-Scholes values for the strike E, which centres the tree on the strike.
+    def p_lr(self):
+        d1 = (log(float(self.S)/self.E) + (self.r+0.5*self.sigma**2.0)*self.T)/(self.sigma*sqrt(self.T))
+        d2 = d1 - self.sigma*sqrt(self.T)
+        return self.peizer_pratt(d2),self.peizer_pratt(d1)
+    
+    ## u,d values from Leisen and Reimer
+    #
+    # \f[ u = e^{r \delta t} \frac{ \bar p }{ p } \f]
+    # \f[ d = \frac{ e^{r \delta t} - pu }{ 1-p } \f]
+    def ud_lr(self):
+        p,pbar = self.p_lr()
+        u = exp(self.r*self.dt)*pbar/p
+        d = (exp(self.r*self.dt)-p*u)/(1.0-p)
+        return u,d
+    
+    ## u,d values of the Boyle trinomial lattice, the middle branch leaves the price unchanged
+    #
+    # \f[ u = e^{\sigma \sqrt{2 \delta t}}, \quad d = 1/u \f]
+    def ud_trinomial(self):
+        u = exp(self.sigma*sqrt(2.0*self.dt))
+        return u,1.0/u
+    
+    ## Branch probabilities of the Boyle trinomial lattice
+    #
+    # \f[ p_u = \left ( \frac{ e^{r \delta t/2} - e^{-\sigma \sqrt{\delta t/2}} }{ e^{\sigma \sqrt{\delta t/2}} - e^{-\sigma \sqrt{\delta t/2}} } \right )^2, \quad
+    #      p_d = \left ( \frac{ e^{\sigma \sqrt{\delta t/2}} - e^{r \delta t/2} }{ e^{\sigma \sqrt{\delta t/2}} - e^{-\sigma \sqrt{\delta t/2}} } \right )^2, \quad
+    #      p_m = 1 - p_u - p_d \f]
+    def p_trinomial(self):
+        a = exp(0.5*self.r*self.dt)
+        b = exp(self.sigma*sqrt(0.5*self.dt))
+        pu = ((a-1.0/b)/(b-1.0/b))**2
+        pd = ((b-a)/(b-1.0/b))**2
+        return pu,1.0-pu-pd,pd
+    
     ## Builds the tree
     #
     # \f[M_1 = [\,M \quad M-1 \quad M-2 \quad ... \quad 0 \, ] \f]
     #\f[M_2  = [\,0 \quad 1 \quad 2 \quad ... \quad M \, ],\f]
     #\f[d_p  = d^{M_1}\f]
     #\f[u_p  = u^{M_2}\f]
+    #
+    # The trinomial lattice has 2M+1 final nodes, \f$M_1 = [\,M \, \cdots \, 0 \, 0 \, \cdots \, 0\,]\f$ and
+    # \f$M_2 = [\,0 \, \cdots \, 0 \, 0 \, \cdots \, M\,]\f$, so that \f$d_p \circ u_p = u^{-M} \cdots u^{M}\f$.
     def tree(self):
         m1 = range(self.M,-1,-1)
         m2 = range(0,self.M+1)
+        if self.method=='trinomial':
+            m1 = m1 + [0]*self.M
+            m2 = [0]*self.M + m2
         dp = self.d**m1
         up = self.u**m2
         return dp,up
@@ -96,15 +178,66 @@ class binomial_euro():
         w = maximum(self.E-self.S*dp*up,0)
         return w
     
+    ## Discounted binomial weights of the final values
+    #
+    # \f[ \omega_j = e^{-rT} \binom{M}{j} p^j (1-p)^{M-j}, \quad 0 \le j \le M \f]
+    # The binomial coefficients are evaluated in log space so that large M does not overflow.
+    def terminal_weights(self):
+        if self.method=='trinomial':
+            raise ValueError("The closed form sum is only available for binomial lattices")
+        j = arange(self.M+1)
+        lnfact = concatenate(([0.0],cumsum(log(arange(1,self.M+1)))))
+        lnw = lnfact[self.M] - lnfact[j] - lnfact[self.M-j] + j*log(self.p) + (self.M-j)*log(1.0-self.p)
+        return exp(lnw - self.r*self.dt*self.M)
+    
     ## Calculates the recursion for solving a binomial tree
     #
     # \f[ V_n^i = e^{-r\delta t}\left ( pV_{n+1}^{i+1} + (1-p) V_n^{i+1} \right ), quad 0 \le n \le i, \quad 0 \le i \le M-1 \f]
+    # The sweep ping-pongs between two preallocated buffers, so no arrays are created inside the loop.
+    # With closed_form=True the recursion is skipped and the value is the O(M) sum
+    # \f[ V_0^0 = \sum_{j=0}^{M} \omega_j W_j \f]
+    # The sweep keeps copies of the first three levels in self.levels, which the Greeks are read from.
     # Returns W, the asset price.
-    def solve(self):
+    def solve(self, closed_form=False):
+        if closed_form:
+            return float(dot(self.terminal_weights(),self.W))
+        if self.method=='trinomial':
+            return self.solve_trinomial()
+        
+        w = copy(self.W)
+        v = empty_like(w)
+        pd = exp(-self.r*self.dt)*self.p
+        qd = exp(-self.r*self.dt)*(1.0-self.p)
+        self.levels = [None]*3
+        for k in range(self.M,0,-1):
+            multiply(w[0:k],qd,out=v[0:k])
+            multiply(w[1:k+1],pd,out=w[1:k+1])
+            add(v[0:k],w[1:k+1],out=v[0:k])
+            w,v = v,w
+            if k<=3:
+                self.levels[k-1] = copy(w[0:k])
+        return float(w[0])
+    
+    ## Calculates the recursion for the trinomial lattice
+    #
+    # \f[ V_n^i = e^{-r\delta t}\left ( p_u V_{n+2}^{i+1} + p_m V_{n+1}^{i+1} + p_d V_n^{i+1} \right ), \quad 0 \le n \le 2i \f]
+    def solve_trinomial(self):
         w = copy(self.W)
+        v = empty_like(w)
+        t = empty_like(w)
+        disc = exp(-self.r*self.dt)
+        self.levels = [None]*3
         for k in range(self.M,0,-1):
-            w = exp(-self.r*self.dt)*(self.p*w[1:k+1] + (1.0-self.p)*w[0:k])
-        return float(w)
+            n = 2*k-1
+            multiply(w[0:n],disc*self.pd,out=v[0:n])
+            multiply(w[1:n+1],disc*self.pm,out=t[0:n])
+            add(v[0:n],t[0:n],out=v[0:n])
+            multiply(w[2:n+2],disc*self.pu,out=t[0:n])
+            add(v[0:n],t[0:n],out=v[0:n])
+            w,v = v,w
+            if k<=3:
+                self.levels[k-1] = copy(w[0:n])
+        return float(w[0])
     
     
 
@@ -128,16 +261,11 @@ class binomial_amer(binomial_euro):
         self.T=T
         self.M=M
         self.p=p
-        self.dt = T/M
+        self.opt=opt
         
-        if method=='higham':
-            self.u,self.d = self.ud_higham()
-        elif method=='crr':
-            self.u,self.d = self.ud_crr()
-        elif method=='kwok':
-            self.u,self.d = self.ud_kwok()
-        else:
-            self.u,self.d=0
+        if method=='trinomial':
+            raise ValueError("binomial_amer requires a binomial u,d method")
+        self.lattice(method)
         
         self.dp,self.up = self.tree()
         
@@ -147,18 +275,181 @@ class binomial_amer(binomial_euro):
             self.W = self.final_values_put()
     
     ## Solves the recurion relation for an American Option
-    def solve(self):
+    #
+    # \f[ V_n^i = \max \left ( \Lambda(S d^{i-n} u^n),\; e^{-r\delta t}\left ( pV_{n+1}^{i+1} + (1-p) V_n^{i+1} \right ) \right ) \f]
+    # The asset prices of each level are rebuilt from the precomputed \f$d_p\f$ and \f$u_p\f$ into
+    # preallocated buffers, so the sweep does not allocate. As a side product the early exercise
+    # boundary is stored in self.boundary, indexed by time level (NaN where nothing is exercised),
+    # and the first three levels in self.levels.
+    #
+    # @param smooth = None for the plain tree, 'bbs' to replace the last step by the Black-Scholes value
+    # or 'bbsr' for BBS with Richardson extrapolation \f$2V_{M}-V_{M/2}\f$
+    def solve(self, smooth=None):
+        if smooth=='bbsr':
+            half = binomial_amer(self.S,self.E,self.r,self.sigma,T=self.T,M=self.M//2,p=self.p,opt=self.opt,method=self.method)
+            return 2.0*self.solve('bbs') - half.solve('bbs')
+        
+        M = self.M
+        pd = exp(-self.r*self.dt)*self.p
+        qd = exp(-self.r*self.dt)*(1.0-self.p)
+        
+        w = copy(self.W)
+        v = empty_like(w)
+        s = empty_like(w)
+        ex = zeros(M+1,dtype=bool)
+        self.boundary = empty(M+1)
+        self.boundary.fill(nan)
+        self.boundary[M] = self.E
+        self.levels = [None]*3
+        
+        if smooth=='bbs':
+            asset = self.S*self.dp[1:]*self.up[0:M]
+            w[0:M] = bs_value(asset,self.E,self.r,self.sigma,self.dt,self.opt)
+        
+        for k in range(M,0,-1):
+            if k==M and smooth=='bbs':
+                # Level M-1 already holds the smoothed continuation values
+                v,w = w,v
+            else:
+                multiply(w[0:k],qd,out=v[0:k])
+                multiply(w[1:k+1],pd,out=w[1:k+1])
+                add(v[0:k],w[1:k+1],out=v[0:k])
+            
+            multiply(self.dp[M-k+1:],self.up[0:k],out=s[0:k])
+            multiply(s[0:k],self.S,out=s[0:k])
+            if self.opt=='put':
+                subtract(self.E,s[0:k],out=s[0:k])
+            else:
+                subtract(s[0:k],self.E,out=s[0:k])
+            greater(s[0:k],v[0:k],out=ex[0:k])
+            maximum(v[0:k],s[0:k],out=v[0:k])
+            self.boundary[k-1] = self.exercise_boundary(ex[0:k],k-1)
+            w,v = v,w
+            if k<=3:
+                self.levels[k-1] = copy(w[0:k])
+        return float(w[0])
+    
+    ## Asset price at which early exercise starts on a tree level
+    #
+    # @param ex = boolean array flagging the exercised nodes of the level
+    # @param i = level of the tree
+    def exercise_boundary(self, ex, i):
+        n = count_nonzero(ex)
+        if n==0:
+            return nan
+        if self.opt=='put':
+            j = n-1
+        else:
+            j = i+1-n
+        return self.S*self.d**(i-j)*self.u**j
+    
+
+
+## Binomial method solver for a batch of European options sharing one tree
+#
+# Every strike in the batch sees the same asset prices \f$S \circ d_p \circ u_p\f$, so the tree is
+# built once and the backward recursion is run a single time on an (strikes \f$\times\f$ nodes) array.
+class binomial_batch(binomial_euro):
+    ## Called upon initialization of the batched binomial method for Europeans
+    #
+    # @param S = Spot Price of asset
+    # @param E = Sequence of Exercise / Strike prices
+    # @param r = Risk free interest rate
+    # @param sigma = Volatility of the asset (\f$\sigma\f$)
+    # @param T = Time to expiry (defaults to 1.0)
+    # @param M = Size of binomial tree (defaults to 400)
+    # @param p = probability (defaults to 0.5)
+    # @param opt = 'call', 'put' or a sequence of these, one per strike (defaults to 'call')
+    # @param method = u,d method, either 'higham', 'kwok' or 'crr' (defaults to 'higham')
+    def __init__(self, S, E, r, sigma, T=1.0, M=400, p=0.5, opt='call', method='higham'):
+        self.S = S
+        self.E = atleast_1d(asarray(E,dtype=float))
+        self.r = r
+        self.T = T
+        self.sigma = sigma
+        self.M = M
+        self.p = p
+        
+        if isinstance(opt,str):
+            opt = [opt]*len(self.E)
+        self.opt = array(opt)
+        
+        if method in ('lr','trinomial'):
+            raise ValueError("binomial_batch requires a strike independent binomial u,d method")
+        self.lattice(method)
+        
+        self.W = self.final_values()
+    
+    ## Determines the final values for every strike at once
+    #
+    # \f[ \boldsymbol W_j = \max(S \circ d_p \circ u_p - E_j, 0) \quad \text{or} \quad \max(E_j - S \circ d_p \circ u_p, 0) \f]
+    def final_values(self):
+        dp,up = self.tree()
+        s = self.S*dp*up
+        E = self.E[:,newaxis]
+        return where((self.opt=='call')[:,newaxis], maximum(s-E,0), maximum(E-s,0))
+    
+    ## Calculates the binomial recursion for all strikes simultaneously
+    #
+    # Uses the same two-buffer sweep (or closed-form sum) as binomial_euro.solve, row by row.
+    # Returns an array of option values, one per strike.
+    def solve(self, closed_form=False):
+        if closed_form:
+            return dot(self.W,self.terminal_weights())
+        
         w = copy(self.W)
+        v = empty_like(w)
+        pd = exp(-self.r*self.dt)*self.p
+        qd = exp(-self.r*self.dt)*(1.0-self.p)
+        self.levels = [None]*3
         for k in range(self.M,0,-1):
-            temp = self.S*self.dp[self.M-i+1:self.M]*self.up[0:i]
-            w = maximum(maximum(self.E-temp,0),exp(-self.r*self.dt)*(self.p*w[1:i]+(1-self.p)*w[0:i]))
-        return float(w)
+            multiply(w[:,0:k],qd,out=v[:,0:k])
+            multiply(w[:,1:k+1],pd,out=w[:,1:k+1])
+            add(v[:,0:k],w[:,1:k+1],out=v[:,0:k])
+            w,v = v,w
+            if k<=3:
+                self.levels[k-1] = copy(w[:,0:k])
+        return copy(w[:,0])
     
 
+## Convergence of the lattice methods against the closed form Black-Scholes value
+#
+# @param steps = sequence of lattice sizes M to try
+# @param methods = sequence of u,d methods to compare
+# @param tol = error level used to report the number of steps each method needs
+#
+# Returns a list of (method, M, value, error) rows and a dictionary mapping each method to the
+# smallest M in steps from which on every error is below tol (None if never reached).
+def convergence_table(S, E, r, sigma, T=1.0, opt='call', steps=(25,50,100,200,400,800,1600), methods=('higham','lr','trinomial'), tol=0.01):
+    exact = bs_value(float(S),E,r,sigma,T,opt)
+    rows = []
+    needed = {}
+    for method in methods:
+        needed[method] = None
+        for M in steps:
+            value = binomial_euro(S,E,r,sigma,T=T,M=M,opt=opt,method=method).solve()
+            err = value-exact
+            rows.append((method,M,value,err))
+            if abs(err)<tol:
+                if needed[method] is None:
+                    needed[method] = M
+            else:
+                needed[method] = None
+    return rows,needed
+
 
 if __name__ == '__main__':
     solve = binomial_euro(3,2,0.05,0.3,M=40000,method='higham')
     #print solve.u
     #print solve.d
     #print solve.W
-    print solve.solve()
\ No newline at end of file
+    print solve.solve()
+    print solve.solve(closed_form=True)
+    
+    amer = binomial_amer(100,100,0.05,0.2,M=100,opt='put')
+    print amer.solve(smooth='bbsr')
+    
+    rows,needed = convergence_table(100,105,0.05,0.2,T=1.0,opt='put',tol=0.001)
+    for method,M,value,err in rows:
+        print '%-10s %6d %12.6f %12.2e' % (method,M,value,err)
+    print needed
\ No newline at end of file
@@ -0,0 +1,69 @@
+## @package pyFi.methods.bs
+# Contains the closed form Black-Scholes solver for European options
+
+from numpy import *
+from scipy.special import ndtr
+
+## Sign of the payoff, +1 for calls and -1 for puts
+#
+# @param opt = 'call', 'put' or a sequence of them
+def option_sign(opt):
+    opt = asarray(opt)
+    bad = (opt!='call') & (opt!='put')
+    if any(bad):
+        raise ValueError("Unknown option type: "+str(opt[bad].ravel()[0]))
+    return where(opt=='put',-1.0,1.0)
+
+## Black-Scholes \f$d_1\f$ and \f$d_2\f$
+#
+# \f[ d_{1,2} = \frac{ \log(S/E) + (r \pm \frac{1}{2}\sigma^2)T }{ \sigma \sqrt{T} } \f]
+def d1_d2(S, E, r, sigma, T):
+    vol = sigma*sqrt(T)
+    d1 = (log(S/E) + (r+0.5*sigma*sigma)*T)/vol
+    return d1,d1-vol
+
+## Black-Scholes value of European options
+#
+# All arguments broadcast against each other, so a whole chain of strikes, expiries or option types
+# is priced in one call. With \f$\phi = 1\f$ for calls and \f$\phi = -1\f$ for puts,
+# \f[ V = \phi \left( S N(\phi d_1) - E e^{-rT} N(\phi d_2) \right) \f]
+# At expiry (T = 0) or with zero volatility the discounted intrinsic value is returned.
+# @param opt = 'call', 'put' or an array of them (defaults to 'call')
+def bs_value(S, E, r, sigma, T, opt='call'):
+    S,E,r,sigma,T = broadcast_arrays(*[asarray(x,dtype=float64) for x in (S,E,r,sigma,T)])
+    phi = option_sign(opt)
+    disc = E*exp(-r*T)
+    with errstate(divide='ignore',invalid='ignore'):
+        d1,d2 = d1_d2(S,E,r,sigma,T)
+        V = phi*(S*ndtr(phi*d1) - disc*ndtr(phi*d2))
+    degenerate = (sigma*sqrt(T))<=0
+    if any(degenerate):
+        V = where(degenerate,maximum(phi*(S-disc),0.0),V)
+    return V[()] if V.ndim==0 else V
+
+## Closed form Black-Scholes solver for Europeans
+class bs_euro():
+    ## Called upon initialization of the closed form solver
+    #
+    # @param S = Spot Price of asset
+    # @param E = Exercise / Strike price, scalar or array
+    # @param r = Risk free interest rate
+    # @param sigma = Volatility of the asset (\f$\sigma\f$)
+    # @param T = Time to expiry (defaults to 1.0)
+    # @param opt = 'call', 'put' or an array of them (defaults to 'call')
+    def __init__(self, S, E, r, sigma, T=1.0, opt='call'):
+        self.S = S
+        self.E = E
+        self.r = r
+        self.sigma = sigma
+        self.T = T
+        self.opt = opt
+
+    ## Returns the option value, an array when any argument is an array
+    def solve(self):
+        return bs_value(self.S,self.E,self.r,self.sigma,self.T,self.opt)
+
+
+if __name__ == '__main__':
+    print bs_euro(100,100,0.05,0.2,T=1.0,opt='call').solve()
+    print bs_value(100,[90,100,110],0.05,0.2,1.0,[['put'],['call']])
@@ -2,11 +2,105 @@
 # Contains finite difference approaches for the Black-Scholes PDE
 
 from numpy import *
-from numpy.linalg import solve
+from scipy.sparse import diags, identity
+from scipy.sparse.linalg import splu
+from scipy.optimize import brentq
 
-## Implicit method for solving BS Equation
-# @todo: DOES NOT CURRENTLY WORK
-# @todo: REQUIRES DOCUMENTATION
+## Creates the spot grid over [0,L]
+#
+# @param grid = 'uniform' for \f$x_n = nh\f$ or 'sinh' for nodes clustered around K and S
+# @param S = spot price the cluster must also cover (defaults to K)
+# @param width = length scale of the solution around K, \f$K\sigma\sqrt{T}\f$ in the solvers (defaults to K/10)
+# @param stretch = width of the sinh cluster in units of width, larger is more uniform (defaults to 3)
+#
+# The sinh grid maps uniform \f$\xi_n \in [0,1]\f$ through
+# \f[ x_n = c + \alpha \sinh \left ( c_1 + (c_2-c_1)\xi_n \right ), \quad c_1 = \sinh^{-1}(-c/\alpha), \quad c_2 = \sinh^{-1}((L-c)/\alpha) \f]
+# with \f$\alpha\f$ = stretch width + |S-K|/2, so the fine cells span both K and S and widen with the
+# spread of the terminal distribution. The centre c starts halfway between K and S and is then moved
+# so that K falls exactly halfway between two nodes, which keeps the error from the payoff kink
+# smooth in M instead of depending on where K lands in its cell.
+def spot_grid(L, M, K, grid='uniform', S=None, width=None, stretch=3.0):
+    if grid=='uniform':
+        return float(L)/(float(M)-1.0)*arange(M)
+    elif grid=='sinh':
+        L = float(L)
+        S = K if S is None else S
+        width = 0.1*K if width is None else width
+        alpha = max(stretch*width + 0.5*abs(S-K),1e-6*L)
+        def nodes(c, xi):
+            c1 = arcsinh(-c/alpha)
+            c2 = arcsinh((L-c)/alpha)
+            return c + alpha*sinh(c1 + (c2-c1)*xi)
+        c = 0.5*(S+K)
+        c1 = arcsinh(-c/alpha)
+        j = int((arcsinh((K-c)/alpha)-c1)/(arcsinh((L-c)/alpha)-c1)*(M-1))
+        j = min(max(j,1),M-3)
+        kink = lambda c: 0.5*(nodes(c,j/(M-1.0))+nodes(c,(j+1)/(M-1.0))) - K
+        if kink(0.0) < 0 < kink(L):
+            c = brentq(kink,0.0,L)
+        x = nodes(c,linspace(0.0,1.0,M))
+        x[0] = 0.0
+        x[M-1] = L
+        return x
+    else:
+        raise ValueError("Unknown grid: "+str(grid))
+
+## Black-Scholes operator coefficients on a possibly non-uniform grid
+#
+# With \f$h^-_n = x_n - x_{n-1}\f$ and \f$h^+_n = x_{n+1} - x_n\f$ the central differences give
+# \f[ (\mathcal{L} U)_n = \alpha_n U_{n-1} + \beta_n U_n + \gamma_n U_{n+1} \f]
+# \f[ \alpha_n = \frac{ \sigma^2 x_n^2 - r x_n h^+_n }{ h^-_n(h^-_n+h^+_n) }, \quad
+#      \beta_n = -\frac{ \sigma^2 x_n^2 - r x_n (h^+_n-h^-_n) }{ h^-_n h^+_n } - r, \quad
+#      \gamma_n = \frac{ \sigma^2 x_n^2 + r x_n h^-_n }{ h^+_n(h^-_n+h^+_n) } \f]
+# which reduce to the usual \f$\frac{1}{2}(\sigma^2 n^2 \mp rn)\f$ and \f$-(\sigma^2 n^2 + r)\f$ on a uniform grid.
+# The first and last rows are left zero for the boundary conditions.
+def bs_coefficients(x, r, sigma):
+    alpha = zeros(len(x))
+    beta = zeros(len(x))
+    gamma = zeros(len(x))
+    
+    xi = x[1:-1]
+    hm = x[1:-1]-x[:-2]
+    hp = x[2:]-x[1:-1]
+    s2 = sigma**2 * xi**2
+    alpha[1:-1] = (s2 - r*xi*hp)/(hm*(hm+hp))
+    beta[1:-1] = -(s2 - r*xi*(hp-hm))/(hm*hp) - r
+    gamma[1:-1] = (s2 + r*xi*hm)/(hp*(hm+hp))
+    return alpha,beta,gamma
+
+## Allocates the storage for a time-space surface
+#
+# @param shape = (number of stored timesteps, M)
+# @param filename = if given the array is a numpy.memmap backed by this file, for surfaces that do not fit in memory
+def surface_storage(shape, filename=None):
+    if filename is None:
+        return empty(shape)
+    return memmap(filename,dtype=float,mode='w+',shape=shape)
+
+## Cubic Lagrange interpolant of the solution at S
+#
+# Uses the four nodes surrounding S (shifted inwards at the ends of the grid).
+def interp_cubic(x, u, S):
+    j = searchsorted(x,S)
+    i0 = min(max(j-2,0),len(x)-4)
+    xs = x[i0:i0+4]
+    y = zeros(u[0].shape)
+    for m in range(4):
+        w = 1.0
+        for l in range(4):
+            if l!=m:
+                w *= (S-xs[l])/(xs[m]-xs[l])
+        y = y + w*u[i0+m]
+    return y
+
+## Theta-scheme (implicit or Crank-Nicolson) solver for the Black-Scholes equation
+#
+# Solves the same problem as BS_fd_explicit by marching
+# \f[ (I - \theta \Delta t \mathcal{L}) \boldsymbol U^{i+1} = (I + (1-\theta) \Delta t \mathcal{L}) \boldsymbol U^{i} \f]
+# where \f$\mathcal{L}\f$ is the central-space Black-Scholes operator. The tridiagonal left hand side is
+# LU factored once and the factors are reused for every timestep, and the scheme is unconditionally
+# stable so k may be far smaller than the explicit solver needs. Crank-Nicolson is started with a few
+# fully implicit half steps (Rannacher smoothing) to damp the oscillations from the payoff kink.
 class BS_fd_implicit():
     ## Called upon initialization of the Finite Difference method for Europeans
     #
@@ -19,8 +113,12 @@ class BS_fd_implicit():
     # @param k = Number of timesteps
     # @param M = Discretization points
     # @param opt = 'call' or 'put' (defaults to 'put')
-    def __init__(self, S, E, r, sigma, L, T=1.0, k=400, M=400, opt='put'):
-        """Initializes all class variables and calculates constants"""
+    # @param theta = 1.0 for fully implicit or 0.5 for Crank-Nicolson (defaults to 0.5)
+    # @param rannacher = Number of fully implicit half timesteps taken first (defaults to 4)
+    # @param grid = 'uniform' or 'sinh' spot grid, see spot_grid (defaults to 'uniform')
+    # @param stretch = width of the sinh cluster in units of \f$E\sigma\sqrt{T}\f$, see spot_grid (defaults to 3)
+    # @param interp = 'cubic' or 'linear' interpolation at the spot (defaults to 'cubic')
+    def __init__(self, S, E, r, sigma, L, T=1.0, k=400, M=400, opt='put', theta=0.5, rannacher=4, grid='uniform', stretch=3.0, interp='cubic'):
         self.S = S
         self.E = E
         self.r = r
@@ -30,93 +128,125 @@ class BS_fd_implicit():
         self.k = k
         self.M = M
         self.opt = opt
+        self.theta = theta
+        self.rannacher = rannacher
+        self.interp = interp
         
-        self.dt = T/k
+        self.dt = float(T)/k
         self.h  = float(L)/(float(M)-1.0)
         
         self.n = array([x for x in range(0,self.M)])
+        self.x = spot_grid(L,M,E,grid,S,E*sigma*sqrt(T),stretch)
+        self.alpha,self.beta,self.gamma = bs_coefficients(self.x,r,sigma)
         
-        self.Mat = self.build_LHS_matrix()
-    
+        self.Lop = self.build_operator()
+        self.factors = {}
     
-    def build_LHS_matrix(self):
-        """Builds the LHS operator matrix (A) for the Black Scholes equation of the form Ax=b"""
-        a = 0.5*self.dt*(self.sigma**2 * self.n**2 - self.r*self.n)
-        b = 1.0 - self.dt*(self.sigma**2 * self.n**2 + self.r)
-        c = 0.5*self.dt*(self.sigma**2*self.n**2 + self.r*self.n)
-        
-        Mat = diag(b) + diag(c[0:self.M-1],1) + diag(a[1:self.M],-1)
-        Mat[0,:] = 0
-        Mat[0,0] = 1
-        Mat[self.M-1,:] = 0
-        Mat[self.M-1,self.M-1] = 1
-        return Mat
+    ## Builds the sparse spatial operator
+    #
+    # \f[ (\mathcal{L} U)_n = \alpha_n U_{n-1} + \beta_n U_n + \gamma_n U_{n+1} \f]
+    # with the coefficients from bs_coefficients, which on a uniform grid are
+    # \f[ \alpha_n = \frac{ 1 }{ 2 }(\sigma^2 n^2 - rn), \quad \beta_n = -(\sigma^2 n^2 + r), \quad \gamma_n = \frac{ 1 }{ 2 }(\sigma^2 n^2 + rn) \f]
+    # The first and last rows are zero so the boundary values are set by update_bc alone.
+    def build_operator(self):
+        return diags([self.alpha[1:],self.beta,self.gamma[:-1]],[-1,0,1],format='csc')
     
+    ## Returns the factored left hand side and the right hand side operator for a step
+    #
+    # Factorizations are cached by (dt, theta), so a run factors at most twice.
+    def factor(self, dt, theta):
+        key = (dt,theta)
+        if key not in self.factors:
+            I = identity(self.M,format='csc')
+            lhs = splu((I - theta*dt*self.Lop).tocsc())
+            rhs = (I + (1.0-theta)*dt*self.Lop).tocsr()
+            self.factors[key] = (lhs,rhs)
+        return self.factors[key]
     
+    ## Creates the spatial array
     def strike(self):
-        """creates a spot array"""
-        return self.h*self.n 
-    
+        return self.x
     
+    ## Initial condition for a call option
+    #
+    # \f[V(S,\tau) = \max(S-E,0) \f]
     def init_values_call(self):
-        """Initial condition for a call option"""
         val = maximum(self.strike()-self.E,0)
         return reshape(val,(self.M,1))
     
-    
+    ## Initial condition for a put option
+    #
+    # \f[ V(S,\tau) = \max(E-S,0) \f]
     def init_values_put(self):
-        """Initial condition for a put option"""
         val = maximum(self.E-self.strike(),0)
         return reshape(val,(self.M,1))
     
-    
-    def update_bc(self,U,i):
-        """Updates the explicit boundary condition for a call or a put"""
+    ## Sets the boundary values at time to expiry tau
+    #
+    # for a put
+    # \f[V(0,\tau) = Ee^{-r\tau}, \quad V(L,\tau) = 0\f]
+    # or for a call
+    # \f[V(0,\tau) = 0, \quad V(L,\tau) = L-Ee^{-r\tau}\f]
+    def update_bc(self,U,tau):
         if self.opt=='put':
-            U[0,0] = self.E*exp(-self.r*self.dt*(i+1))
+            U[0,0] = self.E*exp(-self.r*tau)
             U[self.M-1,0] = 0
         elif self.opt=='call':
-            U[self.M-1,0] = self.L-self.E*exp(-self.r*self.dt*(i+1))
+            U[self.M-1,0] = self.L-self.E*exp(-self.r*tau)
             U[0,0] = 0
         return U
     
-    
-    def solve_1d_surface(self):
-        """Returns a 1D space line for the final time of BS equation"""
+    ## Marches the solution in time, yielding the 1d surface after every timestep
+    #
+    # The first rannacher/2 timesteps are each replaced by two fully implicit half steps.
+    def march(self):
         if self.opt=='call':
-            RHS = self.init_values_call()
+            U = self.init_values_call()
         elif self.opt=='put':
-            RHS = self.init_values_put()
+            U = self.init_values_put()
         
         for i in range(self.k):
-            U = solve(self.Mat,RHS)
-            U = self.update_bc(U,i)
-            RHS = U
-        
-        return U
+            if i < self.rannacher//2:
+                steps = ((0.5*self.dt,1.0),(0.5*self.dt,1.0))
+            else:
+                steps = ((self.dt,self.theta),)
+            
+            tau = self.dt*i
+            for dt,theta in steps:
+                lhs,rhs = self.factor(dt,theta)
+                tau += dt
+                U = self.update_bc(rhs.dot(U),tau)
+                U = lhs.solve(U)
+            yield U
     
+    ## Solves the equation and returns the entire 1d surface
+    def solve_1d_surface(self):
+        for U in self.march():
+            pass
+        return U
     
-    def solve_2d_surface(self):
-        """Returns a time-space surface of the solution of the BS equation"""
-        sol = []
-        
-        if self.opt=='call':
-            Uold = self.init_values_call()
-        elif self.opt=='put':
-            Uold = self.init_values_put()
-        
-        for i in range(self.k):
-            U = dot(self.Mat,Uold)
-            U = self.update_bc(U,i)
-            Uold = U
-            sol.append(U)
-        
+    ## Solves the equation and returns a surface as a function of time and space
+    #
+    # The result is one preallocated (k/stride, M) array, row j holding the solution at
+    # \f$\tau = (j+1)\,\mathrm{stride}\,\Delta t\f$, so that the last row is always \f$\tau = T\f$.
+    # @param stride = store only every stride-th timestep, must divide k (defaults to 1)
+    # @param filename = optional file backing the surface as a numpy.memmap
+    def solve_2d_surface(self, stride=1, filename=None):
+        if self.k%stride != 0:
+            raise ValueError("stride=%d does not divide k=%d, the final timestep would not be stored" % (stride,self.k))
+        sol = surface_storage((self.k//stride,self.M),filename)
+        for i,U in enumerate(self.march()):
+            if (i+1)%stride==0:
+                sol[(i+1)//stride-1] = U[:,0]
+        if filename is not None:
+            sol.flush()
         return sol
     
-    
+    ## Linear Interpolant routine
+    #
+    # \f[y = y_0 + (y_1-y_0)\frac{ x-x_0 }{ x_1-x_0 }\f]
     def interp_solution(self,u,i0,i1):
-        """Interpolates the solution from the 1d surface for the strike price we are interested in"""
-        x = self.n*self.h
+        x = self.x
         x0 = x[i0]
         x1 = x[i1]
         y1 = u[i1]
@@ -125,18 +255,17 @@ class BS_fd_implicit():
         y = y0 + (y1-y0)*(self.S-float(x0))/(float(x1)-float(x0))
         return y
     
-    
+    ## Solves the 1-d surface for the final time then interpolates to the spot price of interest
     def solve(self):
-        """Solves for a particular value by calling interpolation routine"""
         U = self.solve_1d_surface()
-        where = self.S / self.h
-        top = int(ceil(where))
-        bottom = int(floor(where))
+        if self.interp=='cubic':
+            return interp_cubic(self.x,U,self.S)
         
-        if top==bottom:
+        top = searchsorted(self.x,self.S)
+        if self.x[top]==self.S:
             return U[top]
         else:
-            return self.interp_solution(U,bottom,top)
+            return self.interp_solution(U,top-1,top)
 
 ## Solution for the Black Scholes equation using an explicit central-space finite difference solver
 #
@@ -157,29 +286,80 @@ class BS_fd_explicit():
     # @param sigma = Volatility of the asset (\f$\sigma\f$)
     # @param L = Length of spot domain
     # @param T = Time to expiry (defaults to 1.0)
-    # @param k = Number of timesteps
+    # @param k = Number of timesteps (defaults to None, the smallest stable number)
     # @param M = Discretization points
     # @param opt = 'call' or 'put' (defaults to 'put')
-    def __init__(self, S, E, r, sigma, L, T=1.0, k=400, M=400, opt='put'):
+    # @param unstable = 'raise' to refuse a k below the stability limit or 'fix' to raise k to it (defaults to 'raise')
+    # @param tol = Optional target for the time discretization error, k is doubled until it is met
+    # @param grid = 'uniform' or 'sinh' spot grid, see spot_grid (defaults to 'uniform')
+    # @param stretch = width of the sinh cluster in units of \f$E\sigma\sqrt{T}\f$, see spot_grid (defaults to 3)
+    # @param interp = 'cubic' or 'linear' interpolation at the spot (defaults to 'cubic')
+    def __init__(self, S, E, r, sigma, L, T=1.0, k=None, M=400, opt='put', unstable='raise', tol=None, grid='uniform', stretch=3.0, interp='cubic'):
         self.S = S
         self.E = E
         self.r = r
         self.sigma = sigma
         self.L = L
         self.T = T
-        self.k = k
         self.M = M
         self.opt = opt
+        self.interp = interp
         
-        self.dt = T/k
         self.h  = float(L)/(float(M)-1.0)
         
         self.n = array([x for x in range(0,self.M)])
+        self.x = spot_grid(L,M,E,grid,S,E*sigma*sqrt(T),stretch)
+        self.alpha,self.beta,self.gamma = bs_coefficients(self.x,r,sigma)
+        
+        kmin = self.stable_steps()
+        if k is None:
+            k = kmin
+        elif k < kmin:
+            if unstable=='fix':
+                k = kmin
+            else:
+                raise ValueError("k=%d is unstable for this grid, at least %d timesteps are needed" % (k,kmin))
+        self.set_steps(k)
         
-        self.Mat = self.build_matrix()
+        if tol is not None:
+            self.refine_steps(tol)
         
     
-    ## Builds the operator matrix for explicit FD
+    ## Smallest number of timesteps for which the explicit scheme is stable
+    #
+    # The scheme is stable when every diagonal entry of build_matrix is non-negative,
+    # \f[ b_n = 1 + \Delta t \beta_n \ge 0 \f]
+    # On a uniform grid this is tightest at the last interior node n = M-2, giving
+    # \f[ k \ge T \left ( \sigma^2 (M-2)^2 + r \right ) \f]
+    # On a sinh grid the limit is set by the fine cells around E and S instead,
+    # \f$\beta_n \approx -\sigma^2 x_n^2/h_n^2\f$ with \f$h_n\f$ the local spacing. For the same M this
+    # can need more steps than the uniform grid when the cluster is much finer than L/M, but as the
+    # sinh grid reaches the same accuracy with several times fewer nodes it needs fewer steps at
+    # equal accuracy.
+    def stable_steps(self):
+        return max(int(ceil(self.T*max(-self.beta))),1)
+    
+    ## Sets the number of timesteps and rebuilds the operator diagonals
+    def set_steps(self, k):
+        self.k = k
+        self.dt = float(self.T)/k
+        self.a,self.b,self.c = self.build_matrix()
+    
+    ## Doubles the number of timesteps until two successive solutions agree to tol
+    #
+    # The scheme is first order in time, so the change between k and 2k estimates the time error.
+    # Stops after maxiter doublings.
+    def refine_steps(self, tol, maxiter=8):
+        V = float(self.solve())
+        for i in range(maxiter):
+            self.set_steps(2*self.k)
+            V2 = float(self.solve())
+            if abs(V2-V) < tol:
+                break
+            V = V2
+        return self.k
+    
+    ## Builds the diagonals of the operator matrix for explicit FD
     #
     # \f[ \begin{bmatrix}1 & 0 & 0 & \cdots & 0 & 0 & 0 \\ a & b & c & \cdots & 0 & 0 & 0 \\ 0 & a & b &        & 0 & 0 & 0 \\ \vdots  & \vdots &   & \ddots  & & \vdots & \vdots  \\ 0 & 0 & 0 & \cdots & b & c & 0 \\ 0 & 0 & 0 & \cdots & a & b & c \\ 0 & 0 & 0 & \cdots & 0 & 0 & 1 \end{bmatrix}\f]
     #
@@ -188,21 +368,32 @@ class BS_fd_explicit():
     # \f[ a = \frac{ 1 }{ 2 }(\Delta t)rn[\sigma^2 n - r]\\
     #  b = 1- (\Delta t)rn[\sigma^2 n^2 - r]\\
     #  = \frac{ 1 }{ 2 }(\Delta t)rn [ \sigma^2 n + r]. \f]
+    # on a uniform grid, or in general \f$a = \Delta t \alpha_n\f$, \f$b = 1 + \Delta t \beta_n\f$ and
+    # \f$c = \Delta t \gamma_n\f$ with the coefficients from bs_coefficients.
+    #
+    # Only the three diagonals are stored, as (M,1) columns aligned with the rows of the matrix,
+    # with the identity rows for the boundaries folded in.
     def build_matrix(self):
-        a = 0.5*self.dt*(self.sigma**2 * self.n**2 - self.r*self.n)
-        b = 1.0 - self.dt*(self.sigma**2 * self.n**2 + self.r)
-        c = 0.5*self.dt*(self.sigma**2*self.n**2 + self.r*self.n)
-        
-        Mat = diag(b) + diag(c[0:self.M-1],1) + diag(a[1:self.M],-1)
-        Mat[0,:] = 0
-        Mat[0,0] = 1
-        Mat[self.M-1,:] = 0
-        Mat[self.M-1,self.M-1] = 1
-        return Mat
+        a = self.dt*self.alpha
+        b = 1.0 + self.dt*self.beta
+        c = self.dt*self.gamma
+        return reshape(a,(self.M,1)),reshape(b,(self.M,1)),reshape(c,(self.M,1))
+    
+    ## Applies the tridiagonal operator, \f$ U = A U_{old} \f$
+    #
+    # \f[ U_n = a_n U^{old}_{n-1} + b_n U^{old}_n + c_n U^{old}_{n+1} \f]
+    # as an O(M) slice update written into the preallocated U, with tmp as scratch space.
+    def apply_matrix(self,Uold,U,tmp):
+        multiply(self.b,Uold,out=U)
+        multiply(self.a[1:],Uold[:-1],out=tmp[1:])
+        add(U[1:],tmp[1:],out=U[1:])
+        multiply(self.c[:-1],Uold[1:],out=tmp[:-1])
+        add(U[:-1],tmp[:-1],out=U[:-1])
+        return U
     
     ## Creates the spatial array
     def strike(self):
-        return self.h*self.n 
+        return self.x
     
     ## Initial condition for a call option
     #
@@ -240,29 +431,43 @@ class BS_fd_explicit():
         elif self.opt=='put':
             Uold = self.init_values_put()
         
+        U = empty_like(Uold)
+        tmp = empty_like(Uold)
         for i in range(self.k):
-            U = dot(self.Mat,Uold)
+            U = self.apply_matrix(Uold,U,tmp)
             U = self.update_bc(U,i)
-            Uold = U
+            Uold,U = U,Uold
         
-        return U
+        return Uold
     
     ## Solves the equation and returns a surface as a function of time and space
-    def solve_2d_surface(self):
+    #
+    # The result is one preallocated (k/stride, M) array, row j holding the solution at
+    # \f$\tau = (j+1)\,\mathrm{stride}\,\Delta t\f$, so that the last row is always \f$\tau = T\f$.
+    # @param stride = store only every stride-th timestep, must divide k (defaults to 1)
+    # @param filename = optional file backing the surface as a numpy.memmap
+    def solve_2d_surface(self, stride=1, filename=None):
         """Returns a time-space surface of the solution of the BS equation"""
-        sol = []
+        if self.k%stride != 0:
+            raise ValueError("stride=%d does not divide k=%d, the final timestep would not be stored" % (stride,self.k))
+        sol = surface_storage((self.k//stride,self.M),filename)
         
         if self.opt=='call':
             Uold = self.init_values_call()
         elif self.opt=='put':
             Uold = self.init_values_put()
         
+        U = empty_like(Uold)
+        tmp = empty_like(Uold)
         for i in range(self.k):
-            U = dot(self.Mat,Uold)
+            U = self.apply_matrix(Uold,U,tmp)
             U = self.update_bc(U,i)
-            Uold = U
-            sol.append(U)
+            Uold,U = U,Uold
+            if (i+1)%stride==0:
+                sol[(i+1)//stride-1] = Uold[:,0]
         
+        if filename is not None:
+            sol.flush()
         return sol
     
     ## Linear Interpolant routine
@@ -270,7 +475,7 @@ class BS_fd_explicit():
     # \f[y = y_0 + (y_1-y_0)\frac{ x-x_0 }{ x_1-x_0 }\f]
     def interp_solution(self,u,i0,i1):
         """Interpolates the solution from the 1d surface for the strike price we are interested in"""
-        x = self.n*self.h
+        x = self.x
         x0 = x[i0]
         x1 = x[i1]
         y1 = u[i1]
@@ -286,23 +491,23 @@ class BS_fd_explicit():
     def solve(self):
         """Solves for a particular value by calling interpolation routine"""
         U = self.solve_1d_surface()
-        where = self.S / self.h
-        top = int(ceil(where))
-        bottom = int(floor(where))
+        if self.interp=='cubic':
+            return interp_cubic(self.x,U,self.S)
         
-        if top==bottom:
+        top = searchsorted(self.x,self.S)
+        if self.x[top]==self.S:
             return U[top]
         else:
-            return self.interp_solution(U,bottom,top)
+            return self.interp_solution(U,top-1,top)
     
     
 
 
 if __name__ == '__main__':
-    solver = BS_fd_explicit(S=4,E=5,r=0.04,sigma=0.3,M=20,L=10,k=25000,opt='put')
+    solver = BS_fd_explicit(S=4,E=5,r=0.04,sigma=0.3,M=20,L=10,opt='put')
     #print solver.solve_1d_surface()
-    print solver.solve()
+    print solver.k, solver.solve()
     
-    #solver2 = BS_fd_implicit(S=3,E=2,r=0.05,sigma=0.3,M=6,L=10,k=100,opt='put')
+    solver2 = BS_fd_implicit(S=4,E=5,r=0.04,sigma=0.3,M=20,L=10,k=50,opt='put')
     #print solver2.solve_1d_surface()
-    #print solver2.solve()
\ No newline at end of file
+    print solver2.solve()
\ No newline at end of file
@@ -2,13 +2,53 @@
 # Contains Monte Carlo method solvers for option valuation
 
 from numpy import *
-from numpy.random import standard_normal as rm
-from numpy.random import randn
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+try:
+    from . import sampling
+except:
+    import sampling
 
 
+## Merges the running statistics of two sets of samples
+#
+# Chan's parallel form of Welford's update: with \f$\delta = \bar x_b - \bar x_a\f$,
+# \f[ \bar x = \bar x_a + \delta \frac{ n_b }{ n }, \quad M_2 = M_{2,a} + M_{2,b} + \delta^2 \frac{ n_a n_b }{ n } \f]
+# where \f$M_2\f$ is the sum of squared deviations from the mean.
+# Returns the combined (n, mean, M2).
+def combine_stats(na, meana, m2a, nb, meanb, m2b):
+    n = na+nb
+    if n==0:
+        return 0,0.0,0.0
+    delta = meanb-meana
+    mean = meana + delta*nb/float(n)
+    m2 = m2a + m2b + delta*delta*na*nb/float(n)
+    return n,mean,m2
+
+## Running statistics (n, mean, M2) of one array of samples, for use with combine_stats
+#
+# The sums are always accumulated in float64, whatever the precision of x. The deviations are
+# formed block by block, so a float32 chunk never gets a full size float64 copy.
+# @param block = number of samples converted to float64 at a time (defaults to 65536)
+def chunk_stats(x, block=65536):
+    m = mean(x,dtype=float64)
+    m2 = 0.0
+    for i in range(0,len(x),block):
+        d = x[i:i+block].astype(float64)
+        d -= m
+        m2 += dot(d,d)
+    return len(x),m,m2
+
+## Runs one worker's share of a parallel mcfast_euro solve
+#
+# @param task = (solver, samplers, number of samples, target standard error)
+def run_share(task):
+    solver,sources,M,tol = task
+    return solver.accumulate(sources,M,tol)
+
 ## Monte Carlo Method solver for European vanilla options
 class montecarlo_euro():
-    def __init__(self, S, E, r, sigma, T=1, M=10000, opt='call'):
+    def __init__(self, S, E, r, sigma, T=1, M=10000, opt='call', sampler='pseudo'):
         ## Called upon initialization of the Monte Carlo method for Europeans
         #
         # @param S = Spot Price of asset
@@ -18,6 +58,7 @@ class montecarlo_euro():
         # @param T = Time to expiry (defaults to 1.0)
         # @param M = Number of random samples
         # @param opt = 'call' or 'put' (defaults to 'put')
+        # @param sampler = Normal sampler, 'pseudo', 'sobol' or 'halton' (defaults to 'pseudo')
         self.S = S
         self.E = E
         self.sigma = sigma
@@ -25,6 +66,7 @@ class montecarlo_euro():
         self.T = T
         self.M = M
         self.opt = opt
+        self.sampler = sampler
     
     ## Produces the Monte Carlo solution 
     #
@@ -34,9 +76,10 @@ class montecarlo_euro():
     def solve(self):
         """comment"""
         V = zeros(self.M)
+        source = sampling.make_samplers(self.sampler)[0]
         
         for i in range(1,self.M):
-            Sf = self.S*exp((self.r-0.5*self.sigma*self.sigma)*self.T+self.sigma*sqrt(self.T)*rm())
+            Sf = self.S*exp((self.r-0.5*self.sigma*self.sigma)*self.T+self.sigma*sqrt(self.T)*source.normals(1)[0])
             V[i] = exp(-self.r*self.T)*self.gamma(Sf)
         self.meany = mean(V)
         self.bet = std(V)
@@ -63,9 +106,21 @@ class mcfast_euro():
     # @param r = Risk free interest rate
     # @param sigma = Volatility of the asset (\f$\sigma\f$)
     # @param T = Time to expiry (defaults to 1.0)
-    # @param M = Number of random samples
+    # @param M = Number of random samples, the maximum when tol is given
     # @param opt = 'call' or 'put' (defaults to 'put')
-    def __init__(self, S, E, r, sigma, T=1, M=10000, opt='call'):
+    # @param chunk = Number of samples drawn at a time, which bounds the memory use (defaults to 1000000)
+    # @param tol = Optional target standard error, sampling stops as soon as it is reached
+    # @param vr = Variance reduction, None, 'antithetic', 'control' or 'moment' (defaults to None)
+    # @param sampler = Normal sampler, 'pseudo', 'sobol' or 'halton' (defaults to 'pseudo')
+    # @param replicas = Number of independent randomizations of a quasi-random sampler (defaults to 16)
+    # @param seed = Optional integer seed, which makes the result reproducible
+    # @param workers = Number of parallel workers, each with its own random stream (defaults to 1)
+    # @param pool = 'thread' or 'process' workers (defaults to 'thread', NumPy releases the GIL in the sampling)
+    # @param dtype = Precision of the samples and payoffs, float64 or float32 (defaults to float64),
+    # the reductions are always done in float64
+    # @param batches = Number of separately moment matched batches per chunk with vr='moment' and the
+    # pseudo sampler, whose spread gives the standard error (defaults to 16)
+    def __init__(self, S, E, r, sigma, T=1, M=10000, opt='call', chunk=1000000, tol=None, vr=None, sampler='pseudo', replicas=16, seed=None, workers=1, pool='thread', dtype=float64, batches=16):
         self.S = S
         self.E = E
         self.sigma = sigma
@@ -73,16 +128,38 @@ class mcfast_euro():
         self.T = T
         self.M = M
         self.opt = opt
+        self.chunk = chunk
+        self.tol = tol
+        self.vr = vr
+        self.sampler = sampler
+        self.replicas = replicas if sampler!='pseudo' else 1
+        self.seed = seed
+        self.workers = workers
+        self.pool = pool
+        self.dtype = dtype
+        self.batches = batches
     
     
     def gamma(self,sf):
         """docstring for gamma"""
+        E = sf.dtype.type(self.E)
         if self.opt=='put':
-            gam = maximum(self.E-sf,0)
+            gam = maximum(E-sf,0)
         if self.opt=='call':
-            gam = maximum(sf-self.E,0)
+            gam = maximum(sf-E,0)
         return gam
     
+    ## Draws n standard normal variables from a sampler
+    #
+    # With vr='moment' the draws are shifted and scaled so that their sample mean is exactly 0 and
+    # their sample standard deviation exactly 1.
+    def draw(self, n, source):
+        Z = source.normals(n,self.dtype)
+        if self.vr=='moment':
+            Z -= mean(Z)
+            Z /= std(Z)
+        return Z
+    
     ## Vectorized Solution
     #
     # We initialize a random array of variables \f$Z\f$ then calculate the constants
@@ -91,31 +168,377 @@ class mcfast_euro():
     # \f[ C_3 = e^{-rt} \f]
     # We then calculate
     # \f[\boldsymbol S_f = S \circ \exp \left ( C_1 + C_2 \circ \boldsymbol Z \right )\f]
-    # and yield the answer
+    # and the discounted payoffs
+    # \f[ \boldsymbol V = C_3 \circ \boldsymbol \Lambda \left ( S_f \right ) \f]
+    # for n samples.
+    #
+    # Returns the terms Y whose mean is the estimator together with the plain payoffs V, which are
+    # only used to measure the variance reduction. Y is V except for
+    # - 'antithetic': \f$Y = \frac{1}{2}(V(Z) + V(-Z))\f$ over n/2 pairs
+    # - 'control': \f$Y = V - \beta(C_3 S_f - S)\f$, using that \f$E[C_3 S_f] = S\f$ exactly, with \f$\beta\f$ fitted on the chunk
+    def sample(self, n, source):
+        if self.vr=='antithetic':
+            randarray = self.draw(max(n//2,1),source)
+            randarray = concatenate((randarray,-randarray))
+        else:
+            randarray = self.draw(n,source)
+        
+        t = self.dtype
+        c1 = t((self.r-0.5*self.sigma*self.sigma)*self.T)
+        c2 = t(self.sigma*sqrt(self.T))
+        
+        Sf = t(self.S)*exp(c1+c2*randarray)
+        
+        c3 = t(exp(-self.r*self.T))
+        
+        gam = self.gamma(Sf)
+        
+        V  = c3*gam
+        
+        if self.vr=='antithetic':
+            half = len(V)//2
+            Y = 0.5*(V[:half]+V[half:])
+        elif self.vr=='control':
+            X = c3*Sf - t(self.S)
+            beta = t(dot(V-mean(V,dtype=float64),X)/dot(X,X))
+            Y = V - beta*X
+        else:
+            Y = V
+        return Y,V
+    
+    ## Streams M samples from the given samplers in chunks
+    #
+    # The mean and variance are accumulated chunk by chunk with combine_stats, so the memory use is
+    # bounded by the chunk size rather than M. Each chunk is split across the samplers, which are
+    # the independent replicas of a quasi-random sequence, or a single pseudo-random stream.
+    #
+    # Returns (n, per-sampler stats, plain payoff stats, chunk mean stats), each stats being an
+    # (n, mean, M2) triple.
+    def accumulate(self, sources, M, tol=None):
+        R = len(sources)
+        reps = [(0,0.0,0.0)]*R
+        crude = (0,0.0,0.0)
+        batch = (0,0.0,0.0)
+        n = 0
+        # quasi-random replicas already give the error, and matching their points in small batches
+        # would bias the estimate
+        B = self.batches if self.vr=='moment' and self.sampler=='pseudo' else 1
+        while n < M:
+            m = max(min(self.chunk,M-n)//R,1)
+            for j in range(R):
+                for b in range(B):
+                    Y,V = self.sample(max(m//B,2) if B>1 else m,sources[j])
+                    n += len(V)
+                    reps[j] = combine_stats(*(reps[j]+chunk_stats(Y)))
+                    crude = combine_stats(*(crude+chunk_stats(V)))
+                    batch = combine_stats(*(batch+(1,mean(Y,dtype=float64),0.0)))
+                    del Y,V
+            if tol is not None and self.error(reps,batch)[3] <= tol:
+                break
+        return n,reps,crude,batch
+    
+    ## Combines the replica statistics into (n, mean, M2, standard error)
+    #
+    # Moment matched draws are not independent within a batch, so with vr='moment' and the pseudo
+    # sampler every chunk is drawn as self.batches separately matched batches and the standard error
+    # comes from the spread of the batch means instead.
+    # Quasi-random points are not independent at all, so with several replicas the price is the
+    # mean of the replica means and the standard error is their standard deviation over \f$\sqrt{R}\f$.
+    def error(self, reps, batch):
+        R = len(reps)
+        ny,meany,m2 = reps[0]
+        for j in range(1,R):
+            ny,meany,m2 = combine_stats(ny,meany,m2,*reps[j])
+        
+        nb,meanb,m2b = batch
+        if R>1:
+            stderr = std([rep[1] for rep in reps],ddof=1)/sqrt(R)
+        elif self.vr=='moment' and nb>1:
+            stderr = sqrt(m2b/(nb-1.0)/nb)
+        elif ny>1:
+            stderr = sqrt(m2/(ny-1.0)/ny)
+        else:
+            stderr = inf
+        return ny,meany,m2,stderr
+    
+    ## Streams the samples in chunks and yields the answer
+    #
     # \f[ W(S) = \overline{ C_3 \circ \boldsymbol \Lambda \left ( S_f \right ) }\f]
+    # The sample standard deviation and the standard error of the mean are kept in self.bet and
+    # self.stderr, and self.N is the number of payoffs evaluated.
+    #
+    # With workers > 1, M is split evenly over a thread or process pool. Every worker draws from
+    # its own stream spawned from the seed and its partial statistics are merged in worker order,
+    # so the same seed and worker count give a bit-identical result. A tol target is applied to
+    # each worker as tol \f$\sqrt{\mathrm{workers}}\f$.
+    #
+    # The variance reduction factor, the plain per-payoff variance over the achieved one,
+    # \f[ \frac{ \mathrm{Var}(V) }{ N \, \mathrm{stderr}^2 } \f]
+    # is kept in self.vrf. It is the speedup over crude sampling at equal error.
     def solve(self):
-        randarray = randn(self.M)
+        if self.workers==1:
+            sources = sampling.make_samplers(self.sampler,self.replicas,self.seed)
+            n,reps,crude,batch = self.accumulate(sources,self.M,self.tol)
+        else:
+            if self.sampler!='pseudo':
+                raise ValueError("Parallel runs use the 'pseudo' sampler")
+            W = self.workers
+            streams = sampling.spawn_streams(self.seed,W)
+            tol = self.tol*sqrt(W) if self.tol is not None else None
+            tasks = [(self,[sampling.pseudo_sampler(streams[j])],self.M//W+(1 if j<self.M%W else 0),tol) for j in range(W)]
+            
+            if self.pool=='process':
+                pool = Pool(W)
+            else:
+                pool = ThreadPool(W)
+            results = pool.map(run_share,tasks)
+            pool.close()
+            pool.join()
+            
+            n = 0
+            stats = (0,0.0,0.0)
+            crude = (0,0.0,0.0)
+            batch = (0,0.0,0.0)
+            for wn,wreps,wcrude,wbatch in results:
+                n += wn
+                stats = combine_stats(*(stats+wreps[0]))
+                crude = combine_stats(*(crude+wcrude))
+                batch = combine_stats(*(batch+wbatch))
+            reps = [stats]
         
-        c1 = (self.r-0.5*self.sigma*self.sigma)*self.T
-        c2 = self.sigma*sqrt(self.T)
+        ny,meany,m2,stderr = self.error(reps,batch)
+        nv,meanv,m2v = crude
+        
+        self.N = n
+        self.meany = meany
+        self.bet = sqrt(m2/(ny-1.0)) if ny>1 else 0.0
+        self.stderr = stderr
+        crude = m2v/(nv-1.0) if nv>1 else 0.0
+        self.vrf = crude/(n*stderr**2) if stderr>0 else inf
+        return self.meany
+    
+    ## Returns the confidence interval of the solution
+    #
+    # @param z = Number of standard errors either side of the mean (defaults to 1.96, a 95% interval)
+    def certainty(self, z=1.96):
+        return (self.meany-z*self.stderr,self.meany+z*self.stderr)
+    
+    ## Returns the price, its standard error and the confidence interval of the last solve
+    def stats(self, z=1.96):
+        return self.meany,self.stderr,self.certainty(z)
         
-        Sf = self.S*exp(c1+c2*randarray)
         
+    
+## Monte Carlo solver for a batch of European options sharing one set of samples
+#
+# The terminal prices \f$\boldsymbol S_f\f$ are simulated once and every strike is priced against the
+# same samples (common random numbers), which keeps the chain smooth and arbitrage consistent across
+# strikes. Each chunk of \f$S_f\f$ is sorted and with the prefix sums \f$P_k\f$ and \f$Q_k\f$ of
+# \f$S_f\f$ and \f$S_f^2\f$ the payoff sums for a strike with k samples below it are
+# \f[ \sum (E-S_f)^+ = Ek - P_k, \quad \sum (S_f-E)^+ = (P_m - P_k) - E(m-k) \f]
+# and similarly for the squares, so all strikes cost one sort and one search per chunk.
+class mcfast_batch():
+    ## Called upon initialization of the batched Monte Carlo method for Europeans
+    #
+    # @param S = Spot Price of asset
+    # @param E = Sequence of Exercise / Strike prices
+    # @param r = Risk free interest rate
+    # @param sigma = Volatility of the asset (\f$\sigma\f$)
+    # @param T = Time to expiry (defaults to 1.0)
+    # @param M = Number of random samples
+    # @param opt = 'call', 'put' or a sequence of these, one per strike (defaults to 'call')
+    # @param chunk = Number of samples drawn at a time (defaults to 1000000)
+    # @param sampler = Normal sampler, 'pseudo', 'sobol' or 'halton' (defaults to 'pseudo')
+    # @param seed = Optional integer seed, which makes the result reproducible
+    def __init__(self, S, E, r, sigma, T=1, M=10000, opt='call', chunk=1000000, sampler='pseudo', seed=None):
+        self.S = S
+        self.E = atleast_1d(asarray(E,dtype=float))
+        self.sigma = sigma
+        self.r = r
+        self.T = T
+        self.M = M
+        self.chunk = chunk
+        self.sampler = sampler
+        self.seed = seed
+        
+        if isinstance(opt,str):
+            opt = [opt]*len(self.E)
+        self.opt = array(opt)
+    
+    ## Prices every strike against the same samples
+    #
+    # Returns an array of option values, one per strike. The standard errors are kept in self.stderr,
+    # they assume independent draws and so only hold for the 'pseudo' sampler.
+    def solve(self):
+        source = sampling.make_samplers(self.sampler,1,self.seed)[0]
+        
+        c1 = (self.r-0.5*self.sigma*self.sigma)*self.T
+        c2 = self.sigma*sqrt(self.T)
         c3 = exp(-self.r*self.T)
+        E = self.E
+        call = self.opt=='call'
         
-        gam = self.gamma(Sf)
+        s1 = zeros(len(E))
+        s2 = zeros(len(E))
+        n = 0
+        while n < self.M:
+            m = min(self.chunk,self.M-n)
+            Sf = sort(self.S*exp(c1+c2*source.normals(m)))
+            P = concatenate(([0.0],cumsum(Sf)))
+            Q = concatenate(([0.0],cumsum(Sf*Sf)))
+            k = searchsorted(Sf,E)
+            
+            s1 += where(call, (P[m]-P[k]) - E*(m-k), E*k - P[k])
+            s2 += where(call, (Q[m]-Q[k]) - 2.0*E*(P[m]-P[k]) + E*E*(m-k), E*E*k - 2.0*E*P[k] + Q[k])
+            n += m
+            del Sf,P,Q
         
-        V  = c3*gam
+        meany = s1/n
+        var = maximum(s2/n - meany*meany,0)*n/max(n-1.0,1.0)
+        self.N = n
+        self.stderr = c3*sqrt(var/n)
+        return c3*meany
+    
+    
+## Time-stepping Monte Carlo solver for path dependent European options
+#
+# All paths of a block are advanced together one timestep at a time and only running accumulators are
+# kept per path: the running sum for an average, the running maximum and minimum, and a survival weight
+# for a knock-out barrier. The memory is therefore O(block) whatever the number of steps, no
+# (paths \f$\times\f$ steps) matrix is ever formed.
+#
+# The barrier is monitored continuously with a Brownian bridge. A path that stays on the safe side at
+# both ends of a step still crossed the barrier H in between with probability
+# \f[ p = \exp \left ( -\frac{ 2 \log(S_i/H) \log(S_{i+1}/H) }{ \sigma^2 \Delta t } \right ) \f]
+# and its weight is multiplied by \f$1-p\f$.
+class mcpath_euro(mcfast_euro):
+    ## Called upon initialization of the path dependent Monte Carlo method
+    #
+    # @param S = Spot Price of asset
+    # @param E = Exercise / Strike price
+    # @param r = Risk free interest rate
+    # @param sigma = Volatility of the asset (\f$\sigma\f$)
+    # @param T = Time to expiry (defaults to 1.0)
+    # @param M = Number of paths
+    # @param opt = 'call' or 'put' (defaults to 'call')
+    # @param kind = 'asian' (arithmetic average price), 'lookback' (fixed strike on the maximum or minimum)
+    # or 'barrier' (knock-out) (defaults to 'asian')
+    # @param steps = Number of timesteps, which are also the averaging and lookback dates (defaults to 252)
+    # @param barrier = Knock-out level H for kind='barrier'
+    # @param direction = 'down' or 'up' and out barrier (defaults to 'down')
+    # @param block = Number of paths advanced together (defaults to 100000)
+    # @param seed = Optional integer seed, which makes the result reproducible
+    def __init__(self, S, E, r, sigma, T=1, M=10000, opt='call', kind='asian', steps=252, barrier=None, direction='down', block=100000, seed=None):
+        self.S = S
+        self.E = E
+        self.sigma = sigma
+        self.r = r
+        self.T = T
+        self.M = M
+        self.opt = opt
+        self.kind = kind
+        self.steps = steps
+        self.barrier = barrier
+        self.direction = direction
+        self.block = block
+        self.seed = seed
         
-        meany = mean(V)
+        if kind=='barrier' and barrier is None:
+            raise ValueError("A barrier level is needed for kind='barrier'")
+    
+    ## Advances a block of n paths to expiry and returns their discounted payoffs
+    def sample(self, n, source):
+        dt = float(self.T)/self.steps
+        c1 = (self.r-0.5*self.sigma*self.sigma)*dt
+        c2 = self.sigma*sqrt(dt)
         
-        return meany
+        s = empty(n)
+        s.fill(self.S)
+        snew = empty(n)
+        if self.kind=='asian':
+            acc = zeros(n)
+        elif self.kind=='lookback':
+            acc = copy(s)
+        elif self.kind=='barrier':
+            H = float(self.barrier)
+            acc = ones(n)
+            lo = log(s/H)
+            lnew = empty(n)
         
+        for i in range(self.steps):
+            multiply(source.normals(n),c2,out=snew)
+            snew += c1
+            exp(snew,out=snew)
+            snew *= s
+            
+            if self.kind=='asian':
+                acc += snew
+            elif self.kind=='lookback':
+                if self.opt=='call':
+                    maximum(acc,snew,out=acc)
+                else:
+                    minimum(acc,snew,out=acc)
+            elif self.kind=='barrier':
+                log(snew/H,out=lnew)
+                if self.direction=='down':
+                    acc[lnew<=0] = 0.0
+                else:
+                    acc[lnew>=0] = 0.0
+                # Brownian bridge crossing probability, only meaningful where both ends are safe
+                acc *= 1.0-exp(minimum(-2.0*lo*lnew/(self.sigma*self.sigma*dt),0.0))
+                lo,lnew = lnew,lo
+            s,snew = snew,s
         
+        if self.kind=='asian':
+            V = self.gamma(acc/self.steps)
+        elif self.kind=='lookback':
+            V = self.gamma(acc)
+        else:
+            V = acc*self.gamma(s)
+        return exp(-self.r*self.T)*V
     
+    ## Simulates the paths block by block and yields the answer
+    #
+    # The per block statistics are merged with combine_stats. The sample standard deviation and the
+    # standard error of the mean are kept in self.bet and self.stderr.
+    def solve(self):
+        source = sampling.make_samplers('pseudo',1,self.seed)[0]
+        stats = (0,0.0,0.0)
+        while stats[0] < self.M:
+            V = self.sample(min(self.block,self.M-stats[0]),source)
+            stats = combine_stats(*(stats+chunk_stats(V)))
+            del V
+        
+        n,meany,m2 = stats
+        self.N = n
+        self.meany = meany
+        self.bet = sqrt(m2/(n-1.0)) if n>1 else 0.0
+        self.stderr = self.bet/sqrt(n)
+        return self.meany
+
+## Bias of float32 sampling against float64 on the same seed, for every variance reduction mode
+#
+# Returns a dictionary keyed by vr of (bias, float64 standard error). The bias should be far below
+# the standard error, otherwise the float32 payoffs lose accuracy that the sampling error would not hide.
+# @param M = Number of samples of each run (defaults to 20000000)
+# @param seed = Seed shared by both precisions (defaults to 3)
+def float32_bias(S=4, E=5, r=0.04, sigma=0.3, T=1, M=20000000, opt='put', seed=3):
+    result = {}
+    for vr in (None,'antithetic','control','moment'):
+        single = mcfast_euro(S,E,r,sigma,T=T,M=M,opt=opt,vr=vr,seed=seed,dtype=float32)
+        double = mcfast_euro(S,E,r,sigma,T=T,M=M,opt=opt,vr=vr,seed=seed)
+        result[vr] = (single.solve()-double.solve(),double.stderr)
+    return result
+
+
 if __name__ == '__main__':
+    # float32 against float64 first, the difference should be far below the standard error
+    for vr,(bias,stderr) in sorted(float32_bias().items()):
+        print 'float32 bias', vr, bias, stderr
+        assert abs(bias) < 0.01*stderr
+    
     #solve = montecarlo_euro(4,5,0.04,0.3,M=1000000,opt='put')
     #print solve.solve()
     
     solve2 = mcfast_euro(4,5,0.04,0.3,M=500000000,opt='put')
-    print solve2.solve()
\ No newline at end of file
+    print solve2.solve()
@@ -0,0 +1,153 @@
+## @package pyFi.methods.sampling
+# Contains the random and quasi-random normal samplers used by the Monte Carlo solvers
+
+from numpy import *
+from numpy.random import randn, rand, RandomState
+from scipy.special import ndtri
+try:
+    from numpy.random import SeedSequence, default_rng
+except ImportError:
+    SeedSequence = None
+
+## Creates independent random number streams from one seed
+#
+# Uses SeedSequence.spawn where NumPy provides it, otherwise one RandomState per stream seeded
+# with the array [seed, j]. The same seed always gives the same streams.
+# @param seed = integer seed, or None for fresh entropy
+# @param count = number of streams
+def spawn_streams(seed, count):
+    if SeedSequence is not None:
+        return [default_rng(s) for s in SeedSequence(seed).spawn(count)]
+    if seed is None:
+        return [RandomState() for j in range(count)]
+    return [RandomState([seed,j]) for j in range(count)]
+
+## Uniform variables on [0,1) from a stream, or from the global generator when rng is None
+def uniform(rng=None, size=None):
+    if rng is None:
+        return rand() if size is None else rand(size)
+    if hasattr(rng,'random_sample'):
+        return rng.random_sample(size)
+    return rng.random(size)
+
+## Reverses the bits of 32 bit integers held in an int64 array
+def bit_reverse(x):
+    x = ((x >> 1) & 0x55555555) | ((x & 0x55555555) << 1)
+    x = ((x >> 2) & 0x33333333) | ((x & 0x33333333) << 2)
+    x = ((x >> 4) & 0x0F0F0F0F) | ((x & 0x0F0F0F0F) << 4)
+    x = ((x >> 8) & 0x00FF00FF) | ((x & 0x00FF00FF) << 8)
+    x = ((x >> 16) & 0x0000FFFF) | ((x & 0x0000FFFF) << 16)
+    return x
+
+## Radical inverse of the integers i in the given base
+#
+# \f[ \phi_b(i) = \sum_k a_k b^{-k-1}, \quad i = \sum_k a_k b^k \f]
+def radical_inverse(i, base):
+    i = array(i,dtype=int64)
+    x = zeros(len(i))
+    f = 1.0/base
+    while any(i>0):
+        x += f*(i % base)
+        i //= base
+        f /= base
+    return x
+
+## Pseudo-random normal sampler
+class pseudo_sampler():
+    ## Called upon initialization of the sampler
+    #
+    # @param rng = random stream, see spawn_streams (defaults to None, the global generator)
+    def __init__(self, rng=None):
+        self.i = 0
+        self.rng = rng
+
+    ## Returns the next n standard normal variables
+    #
+    # NumPy Generators (1.17 and later) draw float32 directly. The global generator and RandomState
+    # can only draw float64, which is then cast, so on older NumPy float32 saves memory downstream
+    # but the sampling itself is no faster (about 8% overall at M=2e7 with NumPy 1.16).
+    def normals(self, n, dtype=float64):
+        self.i += n
+        if self.rng is None:
+            return randn(n).astype(dtype,copy=False)
+        try:
+            return self.rng.standard_normal(n,dtype=dtype)
+        except TypeError:
+            return self.rng.standard_normal(n).astype(dtype,copy=False)
+
+## Scrambled Sobol normal sampler
+#
+# In one dimension the Sobol sequence is the base 2 van der Corput sequence. Each sampler applies its
+# own random linear matrix scramble and digital shift (Matousek), so independent samplers are
+# independent randomizations of the same low-discrepancy set.
+class sobol_sampler():
+    ## Called upon initialization of the sampler
+    #
+    # @param rng = random stream for the scramble (defaults to None, the global generator)
+    def __init__(self, rng=None):
+        self.i = 0
+        # random lower triangular binary matrix with unit diagonal, stored by columns
+        self.cols = zeros(32,dtype=int64)
+        for j in range(32):
+            col = 1 << (31-j)
+            for m,u in enumerate(uniform(rng,31-j)):
+                if u < 0.5:
+                    col |= 1 << (30-j-m)
+            self.cols[j] = col
+        self.shift = int(uniform(rng)*2**32)
+
+    ## Returns the next n points in (0,1)
+    def uniforms(self, n):
+        x = bit_reverse(arange(self.i,self.i+n,dtype=int64) & 0xFFFFFFFF)
+        self.i += n
+        y = zeros(n,dtype=int64)
+        for j in range(32):
+            y ^= ((x >> (31-j)) & 1)*self.cols[j]
+        y ^= self.shift
+        return (y+0.5)/2.0**32
+
+    ## Returns the next n standard normal variables
+    def normals(self, n, dtype=float64):
+        return ndtri(self.uniforms(n)).astype(dtype,copy=False)
+
+## Randomized Halton normal sampler
+#
+# Uses the radical inverse in the given base, randomized by a random start index and a random
+# shift modulo one (Cranley-Patterson rotation).
+class halton_sampler():
+    ## Called upon initialization of the sampler
+    #
+    # @param base = base of the radical inverse (defaults to 2)
+    # @param rng = random stream for the randomization (defaults to None, the global generator)
+    def __init__(self, base=2, rng=None):
+        self.base = base
+        self.i = int(uniform(rng)*2**20)
+        self.shift = uniform(rng)
+
+    ## Returns the next n points in (0,1)
+    def uniforms(self, n):
+        u = radical_inverse(arange(self.i,self.i+n),self.base) + self.shift
+        self.i += n
+        u -= floor(u)
+        # keep away from 0, where the inverse normal is infinite
+        return where(u>0,u,0.5/2.0**32)
+
+    ## Returns the next n standard normal variables
+    def normals(self, n, dtype=float64):
+        return ndtri(self.uniforms(n)).astype(dtype,copy=False)
+
+## Creates independent samplers
+#
+# @param name = 'pseudo', 'sobol' or 'halton'
+# @param count = number of independent replicas
+# @param seed = optional seed, each replica then gets its own stream from spawn_streams
+def make_samplers(name, count=1, seed=None):
+    rngs = spawn_streams(seed,count) if seed is not None else [None]*count
+    if name=='pseudo':
+        return [pseudo_sampler(rng) for rng in rngs]
+    elif name=='sobol':
+        return [sobol_sampler(rng) for rng in rngs]
+    elif name=='halton':
+        return [halton_sampler(rng=rng) for rng in rngs]
+    else:
+        raise ValueError("Unknown sampler: "+str(name))
@@ -1,53 +1,347 @@
 ## @package pyFi.quotes.api
 # Methods for determining option prices and interest rates
 import urllib
+import urlparse
+import httplib
+import socket
+import threading
+import time
 import re
+import os
+import cPickle
+import atexit
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+
+## Result of one quote request
+#
+# value is the parsed quote (None on failure), error a message (None on success) and attempts the
+# number of requests made.
+quote_result = namedtuple('quote_result',['symbol','value','error','attempts'])
+
+## Parses a Google Finance quote page
+def parse_google(content):
+    m = re.search('id="ref_.*?_l".*?>(.*?)<', content)
+    if m:
+        return float(m.group(1).replace(',',''))
+    return None
+
+## Parses a Yahoo Finance quote page
+def parse_yahoo(content):
+    m = re.search('id="yfs_l84_.*?>(.*?)<',content)
+    if m:
+        return float(m.group(1).replace(',',''))
+    return None
+
+## Parses the 1 year Treasury Note rate from bankrate.com
+def parse_risk_free(content):
+    m = re.search('class="tabledataoddnew">0(.*?)<',content)
+    if m:
+        return float(m.group(1))/100.0
+    return None
+
+## URL templates and parsers of the known sources, %s is replaced by the quoted symbol
+sources = {'google': ('http://finance.google.com/finance?q=%s',parse_google),
+           'yahoo': ('http://finance.yahoo.com/q?s=%s',parse_yahoo),
+           'risk_free': ('http://www.bankrate.com/rates/interest-rates/1-year-treasury-rate.aspx',parse_risk_free)}
+
+## Default time to live of cached quotes in seconds, per source
+ttls = {'google': 5.0, 'yahoo': 5.0, 'risk_free': 6*3600.0}
+
+## Thread safe TTL and LRU cache of quotes and rates
+#
+# Entries are keyed by (source, symbol) and expire after the TTL of their source. Beyond size
+# entries the least recently used one is evicted. With a filename the entries are written to disk
+# (through a temporary file) at most once every interval seconds, from a snapshot taken under the
+# lock, as well as by flush() and at exit. A restarted process reloads the entries that are still
+# fresh. The hits and misses counters show how many requests were saved.
+class quote_cache():
+    ## Called upon initialization of the cache
+    #
+    # @param ttl = dictionary of TTLs in seconds per source, missing sources use ttls (defaults to ttls)
+    # @param size = maximum number of entries (defaults to 1024)
+    # @param filename = optional persistence file, loaded if it exists
+    # @param interval = minimum number of seconds between two writes of the file (defaults to 1)
+    def __init__(self, ttl=None, size=1024, filename=None, interval=1.0):
+        self.ttl = dict(ttls)
+        if ttl is not None:
+            self.ttl.update(ttl)
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.filename = None
+        self.interval = interval
+        self.saved = 0.0
+        self.dirty = False
+        self.save_lock = threading.Lock()
+        if filename is not None:
+            self.persist(filename)
+
+    ## Persists the cache to filename, first loading the fresh entries it already holds
+    def persist(self, filename):
+        with self.lock:
+            self.filename = filename
+            if os.path.exists(filename):
+                f = open(filename,'rb')
+                try:
+                    saved = cPickle.load(f)
+                except Exception:
+                    saved = []
+                f.close()
+                now = time.time()
+                for key,(stamp,value) in saved:
+                    if now-stamp < self.lifetime(key[0]):
+                        self.entries[key] = (stamp,value)
+                self.evict()
+        atexit.register(self.flush)
+
+    ## TTL of a source, a (name, URL template) source uses the TTL of its name
+    def lifetime(self, source):
+        if isinstance(source,tuple):
+            source = source[0]
+        return self.ttl.get(source,5.0)
+
+    ## Returns the cached value of a symbol, or None if it is missing or expired
+    def get(self, source, symbol=''):
+        key = (source,symbol)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time()-entry[0] < self.lifetime(source):
+                self.entries[key] = self.entries.pop(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    ## Stores the value of a symbol
+    def put(self, source, symbol, value):
+        with self.lock:
+            self.entries.pop((source,symbol),None)
+            self.entries[(source,symbol)] = (time.time(),value)
+            self.evict()
+            self.dirty = True
+            due = self.filename is not None and time.time()-self.saved >= self.interval
+        if due:
+            self.flush()
+
+    ## Drops the least recently used entries beyond the size cap
+    def evict(self):
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    ## Writes the entries to the persistence file if anything changed since the last write
+    #
+    # Only the snapshot is taken under the lock, the pickling and writing happen outside it.
+    def flush(self):
+        if self.filename is None or not self.save_lock.acquire(False):
+            return
+        try:
+            with self.lock:
+                if not self.dirty:
+                    return
+                snapshot = list(self.entries.items())
+                self.dirty = False
+                self.saved = time.time()
+            tmp = self.filename+'.tmp'
+            f = open(tmp,'wb')
+            cPickle.dump(snapshot,f,cPickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmp,self.filename)
+        finally:
+            self.save_lock.release()
+
+    ## Removes every entry and resets the counters
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    ## Returns the hit and miss counters and the hit rate
+    def stats(self):
+        total = self.hits+self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries),
+                'hit_rate': self.hits/float(total) if total else 0.0}
+
+## HTTP errors worth retrying
+transient = (socket.error,socket.timeout,httplib.HTTPException)
+
+## Concurrent quote client over pooled keep-alive connections
+#
+# Every worker thread keeps one persistent HTTP/1.1 connection per host, so a batch of symbols costs
+# one connection per worker rather than one per symbol. Requests time out after timeout seconds and
+# network errors or 5xx answers are retried with a linear backoff. Nothing ever prompts: a failed or
+# unparsable quote comes back as a quote_result with its error set. With a quote_cache, fresh
+# quotes are answered from it with attempts=0 and successful fetches are stored in it.
+class quote_client():
+    ## Called upon initialization of the client
+    #
+    # @param source = name of a known source in sources (defaults to 'google')
+    # @param url = URL template overriding the source, %s is replaced by the symbol
+    # @param parser = function of the page content returning the quote or None, overriding the source
+    # @param timeout = per request timeout in seconds (defaults to 5)
+    # @param retries = number of retries after a network error (defaults to 2)
+    # @param backoff = wait before the n-th retry is n*backoff seconds (defaults to 0.1)
+    # @param workers = number of concurrent requests of fetch_many (defaults to 8)
+    # @param cache = optional quote_cache. Entries are keyed by the source name and symbol, or by the
+    # name and URL template when url or parser are overridden, so a stand-in feed never shares
+    # entries with the real source.
+    def __init__(self, source='google', url=None, parser=None, timeout=5.0, retries=2, backoff=0.1, workers=8, cache=None):
+        self.key = source if url is None and parser is None else (source,url or sources[source][0])
+        if url is None or parser is None:
+            if source not in sources:
+                raise ValueError("Unknown quote source: "+str(source))
+            url = url if url is not None else sources[source][0]
+            parser = parser if parser is not None else sources[source][1]
+        self.source = source
+        self.url = url
+        self.parser = parser
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.workers = workers
+        self.local = threading.local()
+        self.pool = None
+
+    ## Persistent connection of the calling thread to a host
+    def connection(self, scheme, host):
+        if not hasattr(self.local,'conns'):
+            self.local.conns = {}
+        key = (scheme,host)
+        if key not in self.local.conns:
+            if scheme=='https':
+                self.local.conns[key] = httplib.HTTPSConnection(host,timeout=self.timeout)
+            else:
+                self.local.conns[key] = httplib.HTTPConnection(host,timeout=self.timeout)
+        return self.local.conns[key]
+
+    ## Drops a broken connection so that the next request reconnects
+    def discard(self, scheme, host):
+        conn = self.local.conns.pop((scheme,host),None)
+        if conn is not None:
+            conn.close()
+
+    ## Returns the status and body of one GET request
+    def get(self, url):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?'+parts.query
+        conn = self.connection(parts.scheme,parts.netloc)
+        try:
+            conn.request('GET',path,headers={'Connection': 'keep-alive'})
+            response = conn.getresponse()
+            body = response.read()
+        except:
+            self.discard(parts.scheme,parts.netloc)
+            raise
+        if response.getheader('connection','').lower()=='close':
+            self.discard(parts.scheme,parts.netloc)
+        return response.status,body
+
+    ## Fetches and parses the quote of one symbol
+    #
+    # @param symbol = stock symbol (defaults to '', for sources without one such as 'risk_free')
+    def fetch(self, symbol=''):
+        if self.cache is not None:
+            value = self.cache.get(self.key,symbol)
+            if value is not None:
+                return quote_result(symbol,value,None,0)
+        url = self.url.replace('%s',urllib.quote(symbol)) if '%s' in self.url else self.url
+        error = None
+        for attempt in range(1,self.retries+2):
+            if attempt > 1:
+                time.sleep(self.backoff*(attempt-1))
+            try:
+                status,body = self.get(url)
+            except transient as e:
+                error = 'Request failed: '+(str(e) or e.__class__.__name__)
+                continue
+            if status >= 500:
+                error = 'HTTP status %d' % status
+                continue
+            if status != 200:
+                return quote_result(symbol,None,'HTTP status %d' % status,attempt)
+            try:
+                value = self.parser(body)
+            except ValueError:
+                value = None
+            if value is None:
+                return quote_result(symbol,None,'No quote available for: '+symbol,attempt)
+            if self.cache is not None:
+                self.cache.put(self.key,symbol,value)
+            return quote_result(symbol,value,None,attempt)
+        return quote_result(symbol,None,error,self.retries+1)
+
+    ## Fetches many symbols concurrently, returning their quote_results in the same order
+    def fetch_many(self, symbols):
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        results = self.pool.map(self.fetch,list(symbols))
+        if self.cache is not None:
+            self.cache.flush()
+        return results
+
+    ## Closes the worker threads
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+## Cache shared by all the quote functions, call cache.persist(filename) to keep it across restarts
+cache = quote_cache()
+
+## Clients used by the single quote functions, one per source
+clients = {}
+
+## Returns the shared client of a source
+def client(source):
+    if source not in clients:
+        clients[source] = quote_client(source,cache=cache)
+    return clients[source]
+
+## Returns the value of a quote_result, raising an IOError for a failed one
+def quote_value(result):
+    if result.error is not None:
+        raise IOError(result.error)
+    return result.value
 
 ## Gets quote for a symbol from Google Finance
 # @param symbol= String name of stock symbol. For example 'GOOG' would be Google
 #
-# Uses urllib to get quote from http://finance.google.com/finance?q=
+# Gets the quote from http://finance.google.com/finance?q= and raises an IOError if none is available
 def get_quote_google(symbol):
-    base_url = 'http://finance.google.com/finance?q='
-    content = urllib.urlopen(base_url + symbol).read()
-    m = re.search('id="ref_.*?_l".*?>(.*?)<', content)
-    if m:
-        quote = m.group(1)
-    else:
-        print 'No quote available for: ' + symbol
-        quote = float(raw_input('Please enter symbol quote: $'))
-    return float(quote)
+    return quote_value(client('google').fetch(symbol))
 
 ## Gets quote for a symbol from Yahoo Finance
 # @param symbol= String name of stock symbol. For example 'GOOG' would be Google
 #
-# Uses urllib to get quote from http://finance.yahoo.com/q?s=
+# Gets the quote from http://finance.yahoo.com/q?s= and raises an IOError if none is available
 def get_quote_yahoo(symbol):
-    base_url = 'http://finance.yahoo.com/q?s='
-    content = urllib.urlopen(base_url + symbol).read()
-    m = re.search('id="yfs_l84_.*?>(.*?)<',content)
-    if m:
-        quote = m.group(1)
-    else:
-        print 'No quote available for: ' + symbol
-        quote = float(raw_input('Please enter symbol quote: $'))
-    return float(quote)
+    return quote_value(client('yahoo').fetch(symbol))
 
 ## Gets the risk free rate
-# Uses 1 year Treasury Note rate from bankrate.com
+# Uses 1 year Treasury Note rate from bankrate.com, raises an IOError if it is not available
 def get_risk_free():
-    base_url = 'http://www.bankrate.com/rates/interest-rates/1-year-treasury-rate.aspx'
-    content = urllib.urlopen(base_url).read()
-    m = re.search('class="tabledataoddnew">0(.*?)<',content)
-    if m:
-        quote = float(m.group(1))/100.0
-    else:
-        print 'No T-Note data available...'
-        quote = float(raw_input('Please enter risk free interest rate: '))
-    return quote
-    
+    return quote_value(client('risk_free').fetch())
+
+## Gets quotes for many symbols concurrently
+# @param symbols = Sequence of stock symbols
+# @param source = 'google' or 'yahoo' (defaults to 'google')
+#
+# Returns a dictionary of quote_results keyed by symbol.
+def get_quotes(symbols, source='google'):
+    return dict((r.symbol,r) for r in client(source).fetch_many(symbols))
+
 
 if __name__ == '__main__':
     #print get_quote_google('GOOG')
     #print get_quote_yahoo('AAPL')
-    print get_risk_free()
\ No newline at end of file
+    #print get_quotes(['GOOG','AAPL','MSFT'])
+    print get_risk_free()